@@ -7,4 +7,5 @@ from schema import *
 from stats import *
 from exceptions import *
 from ingest import *
+from fileops import *
 
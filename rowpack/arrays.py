@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE.txt
+
+"""
+
+Conversion of decoded column values to NumPy arrays, with dtypes from the schema. NumPy is imported
+only when these functions are called, so it is not a requirement of the package.
+
+"""
+
+import datetime
+
+# NumPy dtypes for the Column.python_type of each schema datatype. All other types are stored as objects.
+numpy_dtypes = {
+    int: 'int64',
+    float: 'float64',
+    datetime.date: 'datetime64[D]',
+    datetime.datetime: 'datetime64[us]',
+}
+
+
+def numpy_dtype(python_type):
+    return numpy_dtypes.get(python_type, 'O')
+
+
+def column_array(values, dtype):
+    """Convert a list of values to an array of the given dtype. If the values don't fit the type,
+    integer columns fall back to float64, which can hold nulls as NaN, and everything else to objects"""
+    import numpy as np
+
+    try:
+        return np.array(values, dtype=dtype)
+    except (TypeError, ValueError, OverflowError):
+        pass
+
+    if dtype == 'int64':
+        try:
+            return np.array(values, dtype='float64')
+        except (TypeError, ValueError, OverflowError):
+            pass
+
+    return np.array(values, dtype='O')
+
+
+def field_names(headers):
+    """Make a list of unique, non-empty names for the fields of a structured array"""
+
+    names = []
+    for i, h in enumerate(headers):
+        name = h if h else 'f{}'.format(i)
+
+        base_name, n = name, 1
+        while name in names:
+            name = '{}_{}'.format(base_name, n)
+            n += 1
+
+        names.append(name)
+
+    return names
+
+
+def structured_array(names, arrays):
+    """Combine equal length column arrays into a NumPy structured array"""
+    import numpy as np
+
+    n = len(arrays[0]) if arrays else 0
+
+    a = np.empty(n, dtype=[(name, arr.dtype) for name, arr in zip(names, arrays)])
+
+    for name, arr in zip(names, arrays):
+        a[name] = arr
+
+    return a
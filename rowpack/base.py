@@ -10,14 +10,40 @@ import struct
 
 
 EXTENSION = '.rowpack'
-VERSION = 2
+VERSION = 6
 MAGIC = 'AMBRMPDF'
 
+# Version history
+# 2: Row data is a single gzip stream of msgpack row blocks
+# 3: Each row block is an independent gzip member, and the metadata holds an index
+#    of the blocks, so readers can seek directly to any row.
+# 4: Blocks may be stored in a columnar layout, which is recorded in the metadata.
+# 5: Dates, datetimes and times are msgpack extension types, rather than dicts, and datetimes
+#    keep their microseconds.
+# 6: The metadata is split into sections, each packed separately, after a table of their offsets, so
+#    readers can load large sections, such as the types, uvalues and zone maps, only when they are used.
+
 # 8s: Magic Number, H: Version,
 # I: Number of rows, I: number of columns
 # Q: Start of row data. Q: End of row data Q: End of metadata
+# The end of the row data is the start of the metadata. In files with a block index, appends write blocks and
+# metadata in the ranges left by earlier metadata, so blocks may also be after the metadata
 FILE_HEADER_FORMAT = struct.Struct('>8sHIIQQQ')
 
 FILE_HEADER_FORMAT_SIZE = FILE_HEADER_FORMAT.size
 
+# The first version with sectioned metadata
+SECTIONED_META_VERSION = 6
+
+# Metadata values that pack to more than this many bytes are stored in their own sections
+LAZY_SECTION_SIZE = 1024
+
+# Q: Length of the section table, which follows. The table is an array of (name, offset, length), with
+# offsets from the end of the table
+SECTION_TABLE_FORMAT = struct.Struct('>Q')
+
+# Number of values in each page of a column index in sectioned metadata. A lookup unpacks only the page
+# that may have the value
+INDEX_PAGE_SIZE = 1024
+
 
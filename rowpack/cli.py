@@ -9,7 +9,6 @@ CLI program
 """
 
 import argparse
-from itertools import islice
 import sys
 
 from six import binary_type
@@ -17,6 +16,7 @@ from six import binary_type
 import tabulate
 
 from . import RowpackWriter, RowpackReader, intuit_types, run_stats, ingest
+from .compression import codecs
 
 from .__meta__ import __version__
 
@@ -73,11 +73,12 @@ def head_tail(r, head=True):
     else:
         headers = range(1, 11)
 
-    start, end = (None, 15) if head else (r.n_rows - 15, r.n_rows)
+    start, end = (0, 15) if head else (max(r.n_rows - 15, 0), r.n_rows)
 
-    slc = islice(r, start, end)
+    # Uses the block index, so the tail only decompresses the last block or two
+    slc = r.rows(start, end)
 
-    rows = [(row_types.get(i), i,) + row[:len(headers)] for i, row in enumerate(slc, start if start else 0)]
+    rows = [(row_types.get(i), i,) + row[:len(headers)] for i, row in enumerate(slc, start)]
 
     return rows, headers
 
@@ -274,10 +275,13 @@ def rpingest(args=None):
 
     parser.add_argument('url', type=binary_type, help='Input url')
     parser.add_argument('path', nargs='?', type=binary_type, help='Output file path')
+    parser.add_argument('--codec', help='Compression codec: {}'.format(', '.join(sorted(codecs))))
+    parser.add_argument('--level', type=int, help='Compression level')
 
     args = parser.parse_args()
 
-    path, encoding, warnings = ingest(args.url, args.path, get_cache(), cb=ingest_cb, url_resolver=resolve_url)
+    path, encoding, warnings = ingest(args.url, args.path, get_cache(), cb=ingest_cb, url_resolver=resolve_url,
+                                      codec=args.codec, level=args.level)
     print "Ingested ", path
     if warnings:
         for w in warnings:
@@ -289,13 +293,116 @@ def progress_callback(actitity, arg1, arg2):
     print actitity, arg1, arg2
 
 
+def rpconcat(args=None):
+    from rowpack import concat_files
+
+    parser = argparse.ArgumentParser(
+        prog='rowpack concat',
+        description='Concatenate rowpack files with the same columns, copying the compressed blocks '
+                    'without decompressing them where the files are compatible')
+
+    parser.add_argument('output', type=binary_type, help='Output file path')
+    parser.add_argument('paths', nargs='+', type=binary_type, help='Input file paths')
+    parser.add_argument('-R', '--raw', action='store_true',
+                        help='Copy all of the rows of each file, ignoring the rowspecs of the files after the first')
+    parser.add_argument('--no-stats', action='store_true',
+                        help="Don't merge the column statistics of the files")
+
+    args = parser.parse_args(args)
+
+    n_rows = concat_files(args.output, args.paths, data_rows=not args.raw, stats=not args.no_stats)
+
+    print "Wrote {} rows to {}".format(n_rows, args.output)
+
+
+def rpsplit(args=None):
+    from rowpack import split_file
+
+    parser = argparse.ArgumentParser(
+        prog='rowpack split',
+        description='Split a rowpack file into several files, at block boundaries where possible')
+
+    parser.add_argument('path', type=binary_type, help='Input file path')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-n', '--parts', type=int, help='Number of files to split the input into')
+    group.add_argument('-k', '--rows-per-file', type=int, help='Number of data rows in each file')
+    parser.add_argument('-o', '--output',
+                        help="Output path pattern, with '{}' for the part number. Defaults to the input path "
+                             "with '.{}' before the extension")
+    parser.add_argument('--no-stats', action='store_true',
+                        help="Don't compute the column statistics of the files")
+
+    args = parser.parse_args(args)
+
+    for path in split_file(args.path, parts=args.parts, rows_per_file=args.rows_per_file,
+                           out_pattern=args.output, stats=not args.no_stats):
+        print "Wrote", path
+
+
+def rpsort(args=None):
+    from rowpack import sort_file
+    from rowpack.fileops import SORT_RUN_ROWS
+
+    parser = argparse.ArgumentParser(
+        prog='rowpack sort',
+        description='Sort the data rows of a rowpack file by one or more columns, with an external merge sort '
+                    'for files that are larger than memory')
+
+    parser.add_argument('path', type=binary_type, help='Input file path')
+    parser.add_argument('output', type=binary_type, help='Output file path')
+    parser.add_argument('-b', '--by', required=True, help='Comma separated list of the names of the sort columns')
+    parser.add_argument('-r', '--run-rows', type=int, default=SORT_RUN_ROWS,
+                        help='Number of rows to sort in memory in each run. Default: {}'.format(SORT_RUN_ROWS))
+    parser.add_argument('-j', '--workers', type=int, help='Number of processes that sort runs in parallel')
+
+    args = parser.parse_args(args)
+
+    sort_file(args.path, args.output, args.by.split(','), run_rows=args.run_rows, workers=args.workers)
+
+    print "Wrote", args.output
+
+
+def rpindex(args=None):
+    from rowpack import build_index
+
+    parser = argparse.ArgumentParser(
+        prog='rowpack index',
+        description='Build an index of the values of columns, which is stored in the file, for fast lookups of '
+                    'rows by value')
+
+    parser.add_argument('path', type=binary_type, help='File path')
+    parser.add_argument('-c', '--columns', required=True, help='Comma separated list of the names of the columns')
+
+    args = parser.parse_args(args)
+
+    for c in args.columns.split(','):
+        index = build_index(args.path, c)
+        print "Indexed {} values of {}".format(len(index), c)
+
+
+# Subcommands of rowpack, which have their own arguments
+commands = {
+    'concat': rpconcat,
+    'split': rpsplit,
+    'sort': rpsort,
+    'index': rpindex,
+}
+
+
 def rowpack(args=None):
     from operator import itemgetter
     import sys
 
+    argv = sys.argv[1:] if args is None else args
+
+    if argv and argv[0] in commands:
+        return commands[argv[0]](argv[1:])
+
     parser = argparse.ArgumentParser(
         prog='rowpack',
-        description='Ambry Message Pack Rows file access. Version: {}'.format(__version__))
+        description='Ambry Message Pack Rows file access. Version: {}'.format(__version__),
+        epilog="Other commands: {}. Run 'rowpack <command> -h' for their arguments"
+               .format(', '.join(sorted(commands))))
 
     group = parser.add_mutually_exclusive_group()
 
@@ -318,9 +425,13 @@ def rowpack(args=None):
                         help='With -H or -T, edit line types')
     group.add_argument('-I', '--intuition', action='store_true',
                        help='Run type intuition and stats')
+    parser.add_argument('--sketch', action='store_true',
+                        help='With -I, estimate nuniques, median and the most common values with fixed size sketches')
     group.add_argument('-c', '--csv', help='Output the entire file as CSV')
     parser.add_argument('-R', '--raw', action='store_true',
                         help='With --csv, return all rows, ignoring rowspec')
+    parser.add_argument('--columns',
+                        help='With --csv, a comma separated list of the names of the columns to output')
 
     group.add_argument('-b', '--table', action='store_true',
                        help='Display a selection of records in a table')
@@ -338,10 +449,12 @@ def rowpack(args=None):
     group.add_argument('--encoding', help='With -i, Set ingestion encoding')
     group.add_argument('--filetype', help='With -i, Set the type of the file that will be imported')
     group.add_argument('--urlfiletype', help='With -i, Set the type of the file that will be downloaded')
+    group.add_argument('--codec', help='With -i, Set the compression codec: {}'.format(', '.join(sorted(codecs))))
+    group.add_argument('--level', type=int, help='With -i, Set the compression level')
 
     parser.add_argument('path', nargs='?', type=binary_type, help='File path')
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
 
 
     schema_fields = ['pos', 'name', 'datatype', 'count', 'nuniques', 'min', 'mean', 'max', 'std', 'description']
@@ -351,7 +464,8 @@ def rowpack(args=None):
         path, encoding, warnings = ingest(args.path, args.output, get_cache(),
                                           encoding=args.encoding, filetype=args.filetype, urlfiletype=args.urlfiletype,
                                           cb=ingest_cb,
-                                          url_resolver=resolve_url)
+                                          url_resolver=resolve_url,
+                                          codec=args.codec, level=args.level)
 
         print "Ingested ", path
         if warnings:
@@ -369,7 +483,8 @@ def rowpack(args=None):
                 path, encoding, warnings = ingest(ss.url_str(),
                                                   cache=get_cache(),
                                                   cb=ingest_cb,
-                                                  url_resolver=None)
+                                                  url_resolver=None,
+                                                  codec=args.codec, level=args.level)
                 print "Ingested ", path
                 if warnings:
                     print "Warnings for {}".format(path)
@@ -410,6 +525,7 @@ def rowpack(args=None):
             pm('URL:', r.meta.get('url'))
             pm('rows', r.n_rows)
             pm('cols', r.n_cols)
+            pm('codec', '{} {}'.format(r.codec, r.level if r.level is not None else ''))
             pm('headers', r.headers)
             pm('rowspec', row_spec_str(r=r))
 
@@ -421,7 +537,9 @@ def rowpack(args=None):
         import unicodecsv as csv
         from rowgenerators import SelectiveRowGenerator
 
-        with RowpackReader(path) as r:
+        columns = args.columns.split(',') if args.columns else None
+
+        with RowpackReader(path, columns=columns) as r:
             limit = int(args.limit) if args.limit else None
 
             if not args.raw:
@@ -438,11 +556,16 @@ def rowpack(args=None):
             w = csv.writer(out_f)
 
             try:
-                for i, row in enumerate(rg):
-                    w.writerow(row)
-
-                    if limit and i >= limit:
-                        break
+                if args.raw and not limit:
+                    # Whole blocks at a time, to avoid the per-row overhead
+                    for rows in r.iter_blocks():
+                        w.writerows(rows)
+                else:
+                    for i, row in enumerate(rg):
+                        w.writerow(row)
+
+                        if limit and i >= limit:
+                            break
             except IOError as e:
                 print "ERROR: ", e
 
@@ -461,17 +584,14 @@ def rowpack(args=None):
         print "Run type intuition"
         intuit_types(path)
         print "Run stats"
-        run_stats(path)
+        run_stats(path, sketches=args.sketch)
         return
 
     if args.meta:
         import json
         with RowpackReader(path) as r:
-            d = dict(r.meta.items())
-            try:
-                del d['types']  # Types is a lot of data
-            except KeyError:
-                pass
+            # Types is a lot of data, and with sectioned metadata, isn't loaded unless it is used
+            d = dict((k, r.meta[k]) for k in r.meta if k != 'types')
 
             print json.dumps(d, indent=4)
 
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE.txt
+
+"""
+
+Running, mergeable statistics for columns. Values are added a block at a time, and the statistics of
+two sets of blocks can be merged, so they can be computed while writing, or over blocks in parallel.
+
+"""
+
+from collections import Counter
+from math import sqrt
+from six import integer_types
+from sketch import HyperLogLog, QuantileSketch, MisraGries
+
+# Number of the most common values stored in Column.uvalues, as in tableintuit
+MAX_UVALUES = 100
+
+# Number of counters for the most common values, when computed with sketches
+SKETCH_COUNTERS = 1000
+
+_numeric_types = tuple(integer_types) + (float,)
+
+
+def _to_number(v):
+    """Return a value as a number, or None if it isn't one. Strings are converted with float(), as the
+    tableintuit Stats did, since values from CSV sources are strings. NaN is not a number here, since it
+    would make the moments NaN. """
+
+    if isinstance(v, _numeric_types) and not isinstance(v, bool):
+        n = v
+    elif v is None or isinstance(v, bool):
+        return None
+    else:
+        try:
+            n = float(v)
+        except (TypeError, ValueError):
+            return None
+
+    return n if n == n else None
+
+
+def _numbers(values):
+    """The values of a list that are numbers, or strings of numbers, as numbers"""
+    return [n for n in map(_to_number, values) if n is not None]
+
+
+def _is_hashable(v):
+    try:
+        hash(v)
+        return True
+    except TypeError:
+        return False
+
+
+def _hashable(values):
+    """The values of a list that can be counted, which excludes lists and dicts"""
+    try:
+        hash(tuple(values))
+        return values
+    except TypeError:
+        return [v for v in values if _is_hashable(v)]
+
+
+class ColumnStats(object):
+    """Count, null count, min, max, mean and standard deviation of the numeric values of a column, with the
+    mean and variance combined across blocks with the parallel algorithm of Chan et al. In int and float
+    columns, strings that convert with float() are numeric values.
+
+    If uniques is True, the count of each distinct value is also kept, for the number of uniques, the median
+    and the most common values, which are otherwise None. Values that can't be counted, such as lists, are
+    skipped. If sketches is True, these are estimated with fixed size sketches, from the sketch module,
+    rather than with counts of every distinct value, which may not fit in memory for columns of IDs. """
+
+    def __init__(self, name=None, python_type=None, sketches=False, uniques=True):
+        self.name = name
+        self.python_type = python_type
+        self.sketches = sketches
+        self.uniques = uniques
+
+        # True if the statistics started from stored statistics, which don't have enough information
+        # to update the number of uniques and the median
+        self.partial = False
+
+        self.n = 0  # All values, including nulls
+        self.nulls = 0
+
+        # Moments of the numeric values
+        self.n_numeric = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._min = None
+        self._max = None
+
+        if not uniques:
+            self.counts = None
+            self.distinct = None
+            self.quantiles = None
+        elif sketches:
+            self.counts = MisraGries(SKETCH_COUNTERS)
+            self.distinct = HyperLogLog()
+            self.quantiles = QuantileSketch()
+        else:
+            self.counts = Counter()
+            self.distinct = None
+            self.quantiles = None
+
+    @classmethod
+    def from_column(cls, c, sketches=False, uniques=True):
+        """Create a ColumnStats from the statistics stored in a schema Column, so the statistics of more
+        values can be added to them. The number of uniques and the median can't be updated from the stored
+        values, so they are None, and the counts of the most common values start from the stored uvalues.
+
+        Files written before the count of numeric values was stored don't have it, so it is taken to be the
+        count of non-null values, which is too large if the column has strings, such as in header rows. """
+        from math import isnan
+
+        def f(v):
+            return None if v is None or isnan(v) else v
+
+        s = cls(c.name, c.python_type, sketches, uniques)
+
+        s.n = int(c.count)
+        s.nulls = int(f(c.nulls) or 0)
+
+        if s.is_numeric and f(c.mean) is not None:
+            s.n_numeric = int(c.numerics) if f(c.numerics) is not None else s.n - s.nulls
+            s._mean = c.mean
+            s._m2 = (f(c.std) or 0.0) ** 2 * s.n_numeric
+            s._min = f(c.min)
+            s._max = f(c.max)
+
+        if uniques and sketches:
+            for v, count in (c.uvalues or {}).items():
+                s.counts.add(v, count)
+        elif uniques:
+            s.counts.update(c.uvalues or {})
+
+        s.partial = True
+
+        return s
+
+    @property
+    def is_numeric(self):
+        return self.python_type in (int, float)
+
+    def add_values(self, values):
+        """Add a list of the values of the column in a block"""
+
+        self.n += len(values)
+
+        nulls = values.count(None)
+
+        if self.uniques:
+            non_null = _hashable([v for v in values if v is not None] if nulls else values)
+            self.counts.update(non_null)
+
+            if self.sketches:
+                self.distinct.update(non_null)
+
+        self.nulls += nulls
+
+        if not self.is_numeric:
+            return
+
+        nums = _numbers(values)
+
+        if not nums:
+            return
+
+        n = len(nums)
+        mean = float(sum(nums)) / n
+        m2 = sum((v - mean) ** 2 for v in nums)
+
+        self._merge_moments(n, mean, m2, min(nums), max(nums))
+
+        if self.uniques and self.sketches:
+            self.quantiles.update(nums)
+
+    def remove_values(self, values):
+        """Remove a list of values that were added, such as the values of rows that are dropped when the
+        stored statistics of a file are updated. The min and max aren't changed. """
+
+        self.n -= len(values)
+
+        non_null = [v for v in values if v is not None]
+
+        self.nulls -= len(values) - len(non_null)
+
+        if self.uniques:
+            counts = self.counts.counters if self.sketches else self.counts
+            non_null = _hashable(non_null)
+
+            for v in non_null:
+                if counts.get(v, 0) > 1:
+                    counts[v] -= 1
+                else:
+                    counts.pop(v, None)
+
+            if self.sketches:
+                self.counts.n -= len(non_null)
+
+        if not self.is_numeric:
+            return
+
+        nums = _numbers(non_null)
+
+        if not nums:
+            return
+
+        n = len(nums)
+        rest = self.n_numeric - n
+
+        if rest <= 0:
+            self.n_numeric, self._mean, self._m2 = 0, 0.0, 0.0
+            return
+
+        # The inverse of the merge in _merge_moments
+        mean = float(sum(nums)) / n
+        m2 = sum((v - mean) ** 2 for v in nums)
+
+        rest_mean = (self._mean * self.n_numeric - mean * n) / rest
+
+        self._m2 = max(self._m2 - m2 - (mean - rest_mean) ** 2 * rest * n / self.n_numeric, 0.0)
+        self._mean = rest_mean
+        self.n_numeric = rest
+
+    def _merge_moments(self, n, mean, m2, mn, mx):
+
+        if self.n_numeric == 0:
+            self.n_numeric, self._mean, self._m2, self._min, self._max = n, mean, m2, mn, mx
+            return
+
+        total = self.n_numeric + n
+        delta = mean - self._mean
+
+        self._mean += delta * n / total
+        self._m2 += m2 + delta ** 2 * self.n_numeric * n / total
+        self.n_numeric = total
+
+        self._min = min(self._min, mn)
+        self._max = max(self._max, mx)
+
+    def merge(self, other):
+        """Add the statistics of another ColumnStats for the same column. If the other doesn't keep the
+        distinct values, neither does the merged ColumnStats. """
+
+        self.n += other.n
+        self.nulls += other.nulls
+        self.partial = self.partial or other.partial
+
+        if self.uniques and not other.uniques:
+            self.uniques = False
+            self.counts = self.distinct = self.quantiles = None
+
+        if self.uniques and self.sketches:
+            self.counts.merge(other.counts)
+            self.distinct.merge(other.distinct)
+            self.quantiles.merge(other.quantiles)
+        elif self.uniques:
+            self.counts.update(other.counts)
+
+        if other.n_numeric:
+            self._merge_moments(other.n_numeric, other._mean, other._m2, other._min, other._max)
+
+        return self
+
+    @property
+    def min(self):
+        return self._min
+
+    @property
+    def max(self):
+        return self._max
+
+    @property
+    def mean(self):
+        return self._mean if self.n_numeric else None
+
+    @property
+    def stddev(self):
+        """Population standard deviation"""
+        return sqrt(self._m2 / self.n_numeric) if self.n_numeric else None
+
+    @property
+    def nuniques(self):
+        if self.partial or not self.uniques:
+            return None
+
+        return self.distinct.count() if self.sketches else len(self.counts)
+
+    @property
+    def median(self):
+        """The lower median of the numeric values"""
+
+        if not self.n_numeric or self.partial or not self.uniques:
+            return None
+
+        if self.sketches:
+            return self.quantiles.median
+
+        nums = sorted((n, c) for n, c in ((_to_number(v), c) for v, c in self.counts.items()) if n is not None)
+
+        i = (self.n_numeric - 1) // 2
+
+        for v, c in nums:
+            if i < c:
+                return v
+            i -= c
+
+    p50 = median
+
+    @property
+    def uvalues(self):
+        if not self.uniques:
+            return None
+
+        return dict(self.counts.most_common(MAX_UVALUES))
+
+    def update_column(self, c):
+        """Store the statistics in a schema Column"""
+
+        def f(v):
+            return float(v if v is not None else 'nan')
+
+        c.count = float(self.n)
+        c.nulls = float(self.nulls)
+        c.numerics = float(self.n_numeric)
+        c.nuniques = f(self.nuniques)
+        c.min = f(self.min)
+        c.mean = f(self.mean)
+        c.median = f(self.median)
+        c.max = f(self.max)
+        c.std = f(self.stddev)
+        c.uvalues = self.uvalues
+
+    def __repr__(self):
+        return '<ColumnStats {} n={} nulls={} mean={} std={}>'.format(self.name, self.n, self.nulls,
+                                                                      self.mean, self.stddev)
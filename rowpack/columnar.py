@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE.txt
+
+"""
+
+Columnar block layout. A block is a msgpack array of:
+
+    - The number of rows
+    - The row lengths, compressed, or nil if all of the rows have the same length
+    - An array of column chunks, one per column
+
+Each column chunk is an array of the encoding code, a null bitmap ( or nil if the column has no
+nulls ) and the compressed, msgpack packed, non-null values. Because each column is compressed
+separately, a reader can decompress and unpack only the columns it needs.
+
+"""
+
+import msgpack
+from six import integer_types, string_types
+from compression import compress, decompress
+import base
+from util import pack_default, unpack_hooks
+
+PLAIN = 0  # The values, as is
+DICT = 1  # A list of the distinct values, and an index into that list for each value
+DELTA = 2  # The first integer value, then differences between successive values
+
+
+def _null_bitmap(column):
+    """Return a bitmap with the bit set for each None in the column, or None if there are no nulls"""
+
+    nulls = [i for i, v in enumerate(column) if v is None]
+
+    if not nulls:
+        return None
+
+    bm = bytearray((len(column) + 7) // 8)
+
+    for i in nulls:
+        bm[i >> 3] |= 1 << (i & 7)
+
+    return bytes(bm)
+
+
+def _encode_values(values):
+    """Pick an encoding for the non-null values of a column, returning the code and the encoded values"""
+
+    if values and all(type(v) in integer_types for v in values):
+        deltas = [values[0]] + [b - a for a, b in zip(values, values[1:])]
+
+        # Delta encoding only helps if the differences are smaller than the values, as for sorted
+        # or sequential columns.
+        if max(abs(d) for d in deltas[1:] or [0]) < min(max(abs(v) for v in values), 2 ** 63):
+            return DELTA, deltas
+        else:
+            return PLAIN, values
+
+    if not values or not all(isinstance(v, string_types) for v in values):
+        return PLAIN, values
+
+    distinct = {}
+    for v in values:
+        if v not in distinct:
+            distinct[v] = len(distinct)
+
+    if len(distinct) <= len(values) // 2:
+        dictionary = [None] * len(distinct)
+        for v, i in distinct.items():
+            dictionary[i] = v
+
+        return DICT, [dictionary, [distinct[v] for v in values]]
+
+    return PLAIN, values
+
+
+def _decode_values(encoding, values):
+
+    if encoding == DELTA:
+        out = []
+        t = 0
+        for d in values:
+            t += d
+            out.append(t)
+        return out
+
+    elif encoding == DICT:
+        dictionary, indexes = values
+        return [dictionary[i] for i in indexes]
+
+    else:
+        return values
+
+
+def pack_columns(rows, version=base.VERSION, default=None):
+    """Encode a block of rows in the columnar layout, with the row lengths and column data still
+    uncompressed, for compress_columns. The version is the file format version, which sets how dates
+    and times are encoded, unless default, a msgpack default function, is given. """
+
+    if default is None:
+        default = pack_default(version)
+
+    lengths = [len(row) for row in rows]
+
+    n_cols = max(lengths) if lengths else 0
+
+    if all(l == n_cols for l in lengths):
+        lengths = None
+        columns = zip(*rows)
+    else:
+        columns = zip(*(tuple(row) + (None,) * (n_cols - len(row)) for row in rows))
+
+    chunks = []
+
+    for column in columns:
+        bitmap = _null_bitmap(column)
+
+        values = list(column) if bitmap is None else [v for v in column if v is not None]
+
+        encoding, values = _encode_values(values)
+
+        chunks.append((encoding, bitmap, msgpack.packb(values, default=default, encoding='utf-8')))
+
+    return len(rows), (msgpack.packb(lengths) if lengths is not None else None), chunks
+
+
+def compress_columns(packed, codec, level=None):
+    """Compress the output of pack_columns into the bytes of a block"""
+
+    n_rows, lengths, chunks = packed
+
+    return msgpack.packb([n_rows, compress(lengths, codec, level) if lengths is not None else None,
+                          [(encoding, bitmap, compress(data, codec, level)) for encoding, bitmap, data in chunks]],
+                         use_bin_type=True)
+
+
+def decode_columns(data, codec, positions=None, version=base.VERSION):
+    """Decode the bytes of a columnar block into the number of rows, the row lengths and a list of
+    columns. If positions is given, decode only those columns, with columns beyond the end of the rows
+    returned as Nones. """
+
+    hooks = unpack_hooks(version)
+
+    n_rows, lengths, chunks = msgpack.unpackb(data)
+
+    if lengths is not None:
+        lengths = msgpack.unpackb(decompress(lengths, codec))
+
+    columns = []
+
+    for i in (positions if positions is not None else range(len(chunks))):
+
+        if i >= len(chunks):
+            columns.append([None] * n_rows)
+            continue
+
+        encoding, bitmap, cdata = chunks[i]
+
+        values = _decode_values(encoding, msgpack.unpackb(decompress(cdata, codec), encoding='utf-8', **hooks))
+
+        if bitmap is not None:
+            bitmap = bytearray(bitmap)
+            it = iter(values)
+            values = [None if (bitmap[j >> 3] >> (j & 7)) & 1 else next(it) for j in range(n_rows)]
+
+        columns.append(values)
+
+    return n_rows, lengths, columns
+
+
+def columns_to_rows(n_rows, columns, lengths=None):
+    """Convert a list of columns to a tuple of rows, truncating each row to its original length"""
+
+    if not columns:
+        return ((),) * n_rows
+
+    rows = tuple(zip(*columns))
+
+    if lengths is not None:
+        rows = tuple(row[:l] if l != len(row) else row for row, l in zip(rows, lengths))
+
+    return rows
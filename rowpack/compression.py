@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE.txt
+
+"""
+
+Compression codecs for row blocks. The codec name and level are recorded in the file metadata, so
+the reader can decompress with the same codec that the writer used.
+
+"""
+
+import zlib
+import bz2
+
+DEFAULT_CODEC = 'gzip'
+
+
+class Codec(object):
+    """Compress and decompress one block of packed row data. """
+
+    name = None
+    default_level = None
+
+    def compress(self, data, level=None):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        raise NotImplementedError()
+
+
+class NoneCodec(Codec):
+    """Store blocks uncompressed"""
+
+    name = 'none'
+
+    def compress(self, data, level=None):
+        return data
+
+    def decompress(self, data):
+        return data
+
+
+class GzipCodec(Codec):
+    """Each block is a complete gzip member, the format of version 3 files. """
+
+    name = 'gzip'
+    default_level = 9
+    wbits = 16 + zlib.MAX_WBITS
+
+    def compress(self, data, level=None):
+        compressor = zlib.compressobj(level if level is not None else self.default_level, zlib.DEFLATED, self.wbits)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        return zlib.decompress(data, self.wbits)
+
+
+class ZlibCodec(GzipCodec):
+    """Zlib stream, without the gzip header"""
+
+    name = 'zlib'
+    default_level = 6
+    wbits = zlib.MAX_WBITS
+
+
+class Bz2Codec(Codec):
+    """Levels are clamped to bz2's range of 1 to 9, so level 0, which is no compression for zlib,
+    is the fastest level"""
+
+    name = 'bz2'
+    default_level = 9
+
+    def compress(self, data, level=None):
+        level = level if level is not None else self.default_level
+        return bz2.compress(data, min(max(level, 1), 9))
+
+    def decompress(self, data):
+        return bz2.decompress(data)
+
+
+class LzmaCodec(Codec):
+
+    name = 'lzma'
+    default_level = 6
+
+    def __init__(self, lzma):
+        self.lzma = lzma
+
+    def compress(self, data, level=None):
+        return self.lzma.compress(data, preset=level if level is not None else self.default_level)
+
+    def decompress(self, data):
+        return self.lzma.decompress(data)
+
+
+class Lz4Codec(Codec):
+
+    name = 'lz4'
+    default_level = 0
+
+    def __init__(self, lz4frame):
+        self.lz4frame = lz4frame
+
+    def compress(self, data, level=None):
+        return self.lz4frame.compress(data, compression_level=level if level is not None else self.default_level)
+
+    def decompress(self, data):
+        return self.lz4frame.decompress(data)
+
+
+class ZstdCodec(Codec):
+
+    name = 'zstd'
+    default_level = 3
+
+    def __init__(self, zstd):
+        self.zstd = zstd
+
+    def compress(self, data, level=None):
+        level = level if level is not None else self.default_level
+        return self.zstd.ZstdCompressor(level=level).compress(data)
+
+    def decompress(self, data):
+        return self.zstd.ZstdDecompressor().decompress(data)
+
+
+codecs = {}
+
+
+def register_codec(codec):
+    """Add a codec to the registry, replacing any other codec with the same name"""
+    codecs[codec.name] = codec
+
+
+def get_codec(name):
+    """Return a registered codec by name"""
+    from .exceptions import RowpackError
+
+    try:
+        return codecs[name]
+    except KeyError:
+        raise RowpackError("Unknown or unavailable compression codec '{}'. Available codecs: {}"
+                           .format(name, ', '.join(sorted(codecs))))
+
+
+for _c in (NoneCodec(), GzipCodec(), ZlibCodec(), Bz2Codec()):
+    register_codec(_c)
+
+# Optional codecs, which are registered only if their packages are installed
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+if lzma is not None:
+    register_codec(LzmaCodec(lzma))
+
+try:
+    import lz4.frame
+    register_codec(Lz4Codec(lz4.frame))
+except ImportError:
+    pass
+
+try:
+    import zstandard
+    register_codec(ZstdCodec(zstandard))
+except ImportError:
+    pass
+
+
+def compress(data, codec=DEFAULT_CODEC, level=None):
+    """Compress with a codec named in the registry"""
+    return get_codec(codec).compress(data, level)
+
+
+def decompress(data, codec=DEFAULT_CODEC):
+    """Decompress with a codec named in the registry"""
+    return get_codec(codec).decompress(data)
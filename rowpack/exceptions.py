@@ -17,3 +17,6 @@ class IngestionError(RowpackError):
 
 class RowpackFormatError(RowpackError):
     pass
+
+class RowpackTypeError(RowpackError):
+    pass
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE.txt
+
+"""
+
+Operations on whole rowpack files. Where they can, they copy compressed blocks from one file to another
+without decompressing them, so the cost is mostly the cost of copying the bytes.
+
+"""
+
+from . import RowpackReader, RowpackWriter, Schema
+from stats import block_stats
+from util import EXT_TYPE_VERSION, rows_to_columns
+from math import isnan
+from os.path import abspath
+
+
+def _schema_columns(schema):
+    return [(c.name, c.datatype) for c in schema] if schema else []
+
+
+def _output_schema(schema):
+    """Return a copy of a schema without the column statistics, or None if it has no columns"""
+
+    if not schema or not schema.columns:
+        return None
+
+    s = Schema()
+
+    for c in schema:
+        s.add_column(name=c.name, datatype=c.datatype, description=c.description)
+
+    return s
+
+
+def _has_stats(schema):
+    return bool(schema and schema.columns) and not any(isnan(c.count) for c in schema)
+
+
+def can_copy_blocks(r, w):
+    """Return True if the compressed blocks of a reader can be written to a writer without decoding them"""
+
+    return bool(r.blocks) and r.codec == w.codec and r.layout == w.layout and \
+        (r.version >= EXT_TYPE_VERSION) == (w.version >= EXT_TYPE_VERSION)
+
+
+def copy_rows(r, w, start=0, stop=None, stats=None, decode_stats=False):
+    """Write the rows of a reader from start up to stop to a writer. Blocks that are entirely in the range are
+    copied without decoding them, if the files are compatible, and the rest are decoded, and the rows in the
+    range written again.
+
+    If stats is a list of ColumnStats of all of the rows of the reader, such as from the stored statistics,
+    the values of the rows that aren't copied are removed from it, and it is added to the writer's
+    statistics, for the copied blocks. The rows that are written again are added by the writer. If
+    decode_stats is True, the statistics of the copied blocks are computed by decoding them instead, which
+    is faster than compressing them again.
+
+    Returns the number of blocks that were copied. """
+
+    if stop is None:
+        stop = r.n_rows
+
+    if not can_copy_blocks(r, w):
+        for rows in r.iter_blocks(start=start, stop=stop):
+            w.write_rows(rows)
+
+        return 0
+
+    copied = 0
+
+    columns = [(c.name, c.python_type) for c in w.schema] if w.schema else []
+
+    for n, (offset, length, first_row, n_rows) in enumerate(r.blocks):
+        last_row = first_row + n_rows
+
+        if start <= first_row and last_row <= stop:
+            data = r.read_block_data(n)
+
+            w.copy_block(data, n_rows, r.zonemaps[n] if n < len(r.zonemaps) else None)
+            copied += 1
+
+            if decode_stats and w.record_stats and w.schema:
+                w.add_stats(block_stats(data, columns, w.sketches, w.uniques, codec=r.codec, layout=r.layout,
+                                        version=r.version))
+
+            continue
+
+        if stats is None and (last_row <= start or first_row >= stop):
+            continue
+
+        rows = r.read_block(n)
+
+        if stats is not None:
+            for s, values in zip(stats, rows_to_columns(rows, len(stats))):
+                s.remove_values(values)
+
+        if first_row < stop and last_row > start:
+            w.write_rows(rows[max(start - first_row, 0):stop - first_row])
+
+    if stats is not None:
+        w.add_stats(stats)
+
+    return copied
+
+
+def concat_files(out_path, paths, data_rows=True, stats=True, uniques=False, sketches=False):
+    """Write the rows of several rowpack files to a new file. The files must have the same columns. Blocks of
+    files with the codec, layout and encoding of the first file are copied without decompressing them, and
+    the blocks of other files are decoded and compressed again.
+
+    The metadata is that of the first file. If data_rows is True, and the other files have rowspecs, only
+    their data rows are copied, so their header and comment rows aren't mixed in with the data rows of the
+    output, and the rowspec of the first file still applies. Otherwise all of the rows are copied.
+
+    If stats is True, and all of the files have column statistics, the statistics of the output are merged
+    from the stored statistics of each file. The number of uniques and the median can't be merged, so they are
+    NaN; run run_stats on the output to compute them. The most common values are merged if uniques is True.
+
+    Returns the number of rows written. """
+    from colstats import ColumnStats
+    from .exceptions import RowpackError
+
+    if not paths:
+        raise RowpackError("No files to concatenate")
+
+    if abspath(out_path) in [abspath(p) for p in paths]:
+        raise RowpackError("Can't concatenate into one of the input files: {}".format(out_path))
+
+    readers = [RowpackReader(p) for p in paths]
+
+    try:
+        first = readers[0]
+
+        for p, r in zip(paths[1:], readers[1:]):
+            if _schema_columns(r.schema) != _schema_columns(first.schema):
+                raise RowpackError("Can't concatenate {}; its columns don't match the columns of {}"
+                                   .format(p, paths[0]))
+
+        schema = _output_schema(first.schema)
+
+        stats = stats and all(_has_stats(r.schema) for r in readers)
+
+        first.load_metadata()
+
+        meta = dict(first.meta.items())
+
+        with RowpackWriter(out_path, 'wb', schema=schema, meta=meta, codec=first.codec, level=first.level,
+                           layout=first.layout, stats=stats, uniques=uniques, sketches=sketches) as w:
+
+            for i, r in enumerate(readers):
+                start, stop = r.data_range() if data_rows else (0, r.n_rows)
+
+                if i == 0:
+                    start = 0  # The rowspec of the output is the rowspec of the first file
+
+                if stats and can_copy_blocks(r, w):
+                    file_stats = [ColumnStats.from_column(c, sketches, w.uniques) for c in r.schema]
+                else:
+                    file_stats = None
+
+                copy_rows(r, w, start, stop, file_stats)
+
+            rs = w.meta.get('rowspec')
+
+            if rs and rs.get('end') not in (None, ''):
+                w.meta['rowspec'] = dict(rs, end=w.n_rows - 1)
+
+        return w.n_rows
+
+    finally:
+        for r in readers:
+            r.close()
+
+
+def _split_points(r, start, stop, parts):
+    """Return parts + 1 row numbers that divide the rows from start to stop into parts of about the same
+    size, at block boundaries where that doesn't leave a part empty. There must be at least as many rows
+    as parts. """
+    from bisect import bisect_left
+
+    boundaries = sorted(set([start, stop] + [b for b in r._block_starts if start < b < stop]))
+
+    points = [start]
+
+    for i in range(1, parts):
+        target = start + (stop - start) * i // parts
+
+        # The nearest block boundary
+        j = bisect_left(boundaries, target)
+        near = min(boundaries[max(j - 1, 0):j + 1], key=lambda b: abs(b - target))
+
+        # Leave at least one row for each of the remaining parts
+        points.append(near if points[-1] < near <= stop - (parts - i) else max(target, points[-1] + 1))
+
+    points.append(stop)
+
+    return points
+
+
+def split_file(path, parts=None, rows_per_file=None, out_pattern=None, stats=True, uniques=False,
+               sketches=False):
+    """Split a rowpack file into several files, each with parts of the data rows. With parts, the file is
+    split into that many files of about the same number of rows, at block boundaries, so the blocks are
+    copied without decompressing them, or into one file for each data row if there are fewer. With
+    rows_per_file, each file but the last has exactly that many data rows, and blocks that are split between
+    files are decoded and compressed again.
+
+    Each file starts with the header and comment rows before the data rows of the input file, and has its
+    metadata, with the end of the rowspec updated. Rows after the end of the data rows are in the last file.
+
+    The files are named with out_pattern, a format string for the part number, from 0, which defaults to the
+    path with '.{}' before the extension. If stats is True, the column statistics of each file are computed
+    by decoding its blocks, and with uniques, its number of uniques, median and most common values.
+
+    Returns the list of the paths of the files written. """
+    from os.path import splitext
+    from .exceptions import RowpackError
+
+    if (parts is None) == (rows_per_file is None):
+        raise RowpackError("Must specify one of parts or rows_per_file")
+
+    if out_pattern is None:
+        base, ext = splitext(path)
+        out_pattern = base + '.{}' + ext
+
+    out_paths = []
+
+    with RowpackReader(path) as r:
+        r.load_metadata()
+
+        start, stop = r.data_range()
+
+        if parts is not None:
+            # There are no more parts than data rows, and a file with no data rows is split into one file
+            points = _split_points(r, start, stop, max(min(int(parts), stop - start), 1))
+        else:
+            rows_per_file = max(int(rows_per_file), 1)
+            # A file with no data rows is split into one file, with just the header rows and metadata
+            points = (list(range(start, stop, rows_per_file)) or [start]) + [stop]
+
+        # Rows after the data rows go in the last part
+        points[-1] = r.n_rows
+
+        schema = _output_schema(r.schema)
+
+        for i, (part_start, part_stop) in enumerate(zip(points, points[1:])):
+            out_path = out_pattern.format(i)
+
+            if abspath(out_path) == abspath(path):
+                raise RowpackError("Can't split a file into itself: {}".format(out_path))
+
+            with RowpackWriter(out_path, 'wb', schema=schema, meta=dict(r.meta.items()), codec=r.codec,
+                               level=r.level, layout=r.layout, stats=stats, uniques=uniques,
+                               sketches=sketches) as w:
+
+                if start > 0:
+                    copy_rows(r, w, 0, start)
+
+                copy_rows(r, w, part_start, part_stop, decode_stats=stats)
+
+                rs = w.meta.get('rowspec')
+
+                if rs and rs.get('end') not in (None, ''):
+                    footer = r.n_rows - stop if part_stop == r.n_rows else 0
+                    w.meta['rowspec'] = dict(rs, end=w.n_rows - footer - 1)
+
+            out_paths.append(out_path)
+
+    return out_paths
+
+
+# Default number of rows that are sorted in memory, in each run of an external sort
+SORT_RUN_ROWS = 500000
+
+
+def _sort_key(positions):
+    """Return a key function for sorting rows by the values at positions, with nulls after other values"""
+
+    def key(row):
+        return tuple((row[i] is None, row[i]) if i < len(row) else (True, None) for i in positions)
+
+    return key
+
+
+def _sort_run(args):
+    """Sort the rows of a file from start up to stop, and write them to a run file. Takes a single tuple of
+    arguments, for Pool.map"""
+
+    path, start, stop, positions, run_path = args
+
+    with RowpackReader(path) as r:
+        rows = sorted(r.rows(start, stop), key=_sort_key(positions))
+
+    with RowpackWriter(run_path, 'wb', codec='none', zonemaps=False, stats=False) as w:
+        w.write_rows(rows)
+
+    return run_path
+
+
+def _merge_runs(run_paths, positions):
+    """Generate the rows of sorted run files, in order. Equal rows are in the order of the runs"""
+    from heapq import merge
+
+    key = _sort_key(positions)
+
+    def decorated(i, r):
+        for j, row in enumerate(r):
+            yield key(row), i, j, row
+
+    readers = [RowpackReader(p) for p in run_paths]
+
+    try:
+        for k, i, j, row in merge(*[decorated(i, r) for i, r in enumerate(readers)]):
+            yield row
+    finally:
+        for r in readers:
+            r.close()
+
+
+def sort_file(path, out_path, by, run_rows=SORT_RUN_ROWS, workers=None):
+    """Write the rows of a file to a new file, with the data rows sorted by the values of one or more columns,
+    given by name or position, in ascending order, with nulls last. The header and comment rows before the data
+    rows, and any rows after them, are written before and after the sorted rows.
+
+    Files that are larger than memory are sorted externally: runs of run_rows rows are sorted in memory and
+    written to temporary files, in a pool of workers processes if workers is set, and the runs are merged.
+
+    The output has the metadata and column statistics of the input, and new zone maps, which can skip many
+    more blocks for predicates on the sort columns. """
+    import shutil
+    import tempfile
+    from multiprocessing import Pool
+    from itertools import chain
+    from os.path import join
+    from six import string_types
+    from .exceptions import RowpackError
+
+    if abspath(out_path) == abspath(path):
+        raise RowpackError("Can't sort a file into itself: {}".format(out_path))
+
+    if isinstance(by, string_types) or isinstance(by, int):
+        by = [by]
+
+    run_rows = max(int(run_rows), 1)
+
+    with RowpackReader(path) as r:
+        r.load_metadata()
+
+        positions = r.column_positions(by)
+
+        start, stop = r.data_range()
+
+        tmp_dir = tempfile.mkdtemp(prefix='rowpack-sort-')
+
+        try:
+            if stop - start > run_rows:
+                runs = [(path, i, min(i + run_rows, stop), positions, join(tmp_dir, 'run{}.rp'.format(n)))
+                        for n, i in enumerate(range(start, stop, run_rows))]
+
+                if workers and workers > 1:
+                    pool = Pool(workers)
+
+                    try:
+                        run_paths = pool.map(_sort_run, runs)
+                    finally:
+                        pool.close()
+                        pool.join()
+                else:
+                    run_paths = [_sort_run(run) for run in runs]
+
+                rows = _merge_runs(run_paths, positions)
+
+            else:
+                rows = iter(sorted(r.rows(start, stop), key=_sort_key(positions)))
+
+            # The rows are the same, so the statistics are too
+            with RowpackWriter(out_path, 'wb', schema=r.schema if r.schema.columns else None,
+                               meta=dict(r.meta.items()), codec=r.codec, level=r.level, layout=r.layout,
+                               stats=False) as w:
+
+                for row in chain(r.rows(0, start), rows, r.rows(stop, None)):
+                    w.write_row(row)
+
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return out_path
+
+
+def build_index(path, c):
+    """Build an index of the values of a column, given by name or position, and store it in the metadata of
+    the file, for RowpackReader.lookup. The index is a dict of each value to the list of the (block, offset)
+    of the rows with the value, so a lookup reads only those blocks. It is kept up to date when rows are
+    appended. In files with sectioned metadata, the index is stored in pages sorted by value, and a lookup
+    reads only the page that would have the value.
+
+    Returns the index. """
+    from util import index_values
+    from .exceptions import RowpackError
+
+    with RowpackReader(path) as r:
+        pos = r.column_positions([c])[0]
+
+        if not r.schema.columns or pos >= len(r.schema.columns):
+            raise RowpackError("Can't index column '{}' of {}; only columns in the schema can be indexed"
+                               .format(c, path))
+
+        if r.n_rows and not r.blocks:
+            raise RowpackError("Can't index a version {} file, which has no block index; path = {}"
+                               .format(r.version, path))
+
+        name = r.schema[pos].name
+
+        index = {}
+
+        for n in range(len(r.blocks)):
+            index_values(index, r.read_block_columns(n, [pos])[0], n)
+
+    with RowpackWriter(path, 'r+b') as w:
+        w.indexes[name] = index
+
+    return index
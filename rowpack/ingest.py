@@ -6,7 +6,8 @@
 Try to automatically ingest row data from a URL into a Rowpack file.
 """
 
-from . import RowpackWriter, RowpackReader, intuit_rows, intuit_types, run_stats, IngestionError
+from . import RowpackWriter, intuit_rows, intuit_types, run_stats, IngestionError
+from .stats import INTUIT_ROWS, intuit_row_types, intuit_column_types, types_schema
 from os.path import abspath
 
 def get_cache():
@@ -16,8 +17,35 @@ def get_cache():
     return fsopendir(tempfile.gettempdir())
 
 
+def intuit_prefix(w, rows, warnings, cb=None):
+    """Read the first rows from an iterator, run row and type intuition on them, and store the rowspec and
+    schema in the writer, so the writer computes the column statistics as the rows are written. Returns the
+    rows that were read, which have not been written. """
+    from itertools import islice
+
+    prefix = list(islice(rows, INTUIT_ROWS))
+
+    ri = intuit_row_types(prefix)
+
+    w.meta['rowspec'] = ri.spec
+    w.meta['headers'] = ri.headers
+
+    if ri.start_line < 1:
+        warnings.append("WARNING: Row intuition could not find start line; skipping type intuition and stats" +
+                        "Set row types manually with -H -e ")
+        if cb:
+            cb(warnings[-1])
+    else:
+        ti = intuit_column_types(prefix, ri.spec)
+
+        w.schema = types_schema(ti)
+        w.meta['types'] = list(ti.to_rows())
+
+    return prefix
+
+
 def ingest(url, path=None, cache=None, encoding=None, filetype=None, urlfiletype=None,
-           cb=None, url_resolver=None):
+           cb=None, url_resolver=None, codec=None, level=None, single_pass=True):
     """
 
     :param url:
@@ -26,13 +54,17 @@ def ingest(url, path=None, cache=None, encoding=None, filetype=None, urlfiletype
     :param encoding:
     :param filetype:
     :param urlfiletype:
+    :param codec: Compression codec name for the rowpack file
+    :param level: Compression level
+    :param single_pass: If True, run row and type intuition on the first rows, compute the statistics while
+        writing, and write the metadata once. If False, write the rows, then run each stage over the file
     :return:
     """
 
     from rowgenerators import SourceSpec
 
     from tableintuit.exceptions import RowIntuitError
-    import sys
+    from itertools import islice, chain
 
     warnings = []
 
@@ -51,48 +83,95 @@ def ingest(url, path=None, cache=None, encoding=None, filetype=None, urlfiletype
 
     in_path = path
 
-    for encoding in encodings:
+    w = None
+    intuited = False
 
-        d = dict(
-            url=url,
-            encoding=encoding,
-            filetype=filetype,
-            urlfiletype=urlfiletype
-        )
+    # (first row, encoding) for each encoding that rows were written with
+    row_encodings = []
 
-        if url_resolver:
-            ss = url_resolver(SourceSpec(**d), cache)
-        else:
-            ss = SourceSpec(**d)
+    try:
+        for encoding in encodings:
 
-        gen = ss.get_generator(cache)
+            d = dict(
+                url=url,
+                encoding=encoding,
+                filetype=filetype,
+                urlfiletype=urlfiletype
+            )
 
-        if not in_path:
-            path = abspath(ss.file_name + '.rp')
-        else:
-            path = in_path
+            if url_resolver:
+                ss = url_resolver(SourceSpec(**d), cache)
+            else:
+                ss = SourceSpec(**d)
+
+            gen = ss.get_generator(cache)
 
-        try:
-            with RowpackWriter(path) as w:
-                for row in gen:
+            if w is None:
+                if not in_path:
+                    path = abspath(ss.file_name + '.rp')
+                else:
+                    path = in_path
+
+                # The values aren't converted to the intuited types, so the schema can't be enforced. All of
+                # the statistics are computed, as run_stats does for ingests that aren't single pass
+                w = RowpackWriter(path, codec=codec, level=level, uniques=True, strict=False)
+
+            # If an earlier encoding failed part way through, the rows before the failure are already written,
+            # and are skipped rather than written again. They may decode differently with this encoding, such as
+            # utf8 text read as latin1, so they keep the earlier encoding, which is recorded in the metadata
+            n_written = w.n_rows + len(w.cache)
+
+            row_encodings.append((n_written, encoding))
+
+            try:
+                rows = islice(iter(gen), n_written, None)
+
+                if single_pass and not intuited:
+                    rows = chain(intuit_prefix(w, rows, warnings, cb), rows)
+                    intuited = True
+
+                for row in rows:
                     w.write_row(row)
-                w.meta['encoding'] = encoding
-                w.meta['url'] = url
-                w.meta['filename'] = path
+
                 break
-        except UnicodeDecodeError:
-            warnings.append("WARNING: encoding failed, trying another")
+
+            except UnicodeDecodeError:
+                warnings.append("WARNING: encoding {} failed after {} rows, trying another"
+                                .format(encoding, w.n_rows + len(w.cache)))
+                if cb:
+                    cb(warnings[-1])
+                continue
+
+        else:
+            raise IngestionError("ERROR: all encodings failed")
+
+        # The encoding that succeeded, which is the encoding of all of the rows unless encodings has more than
+        # one entry. Encodings that failed before any rows were written with them are dropped
+        w.meta['encoding'] = encoding
+        w.meta['encodings'] = [(first_row, enc) for i, (first_row, enc) in enumerate(row_encodings)
+                               if i + 1 == len(row_encodings) or row_encodings[i + 1][0] > first_row]
+
+        if len(w.meta['encodings']) > 1:
+            warnings.append("WARNING: rows were decoded with more than one encoding: " +
+                            ', '.join("{} from row {}".format(enc, first_row)
+                                      for first_row, enc in w.meta['encodings']))
             if cb:
                 cb(warnings[-1])
-            continue
+        w.meta['url'] = url
+        w.meta['filename'] = path
 
-    else:
-        raise IngestionError("ERROR: all encodings failed")
+        if single_pass:
+            w.meta['sourcespec'] = ss.dict
 
-    # Need to re-open b/c n_rows isn't set until the writer is closed
-    with RowpackReader(path) as r:
-        if cb:
-            cb("Wrote {} rows".format(r.n_rows))
+    finally:
+        if w is not None:
+            w.close()
+
+    if cb:
+        cb("Wrote {} rows".format(w.n_rows))
+
+    if single_pass:
+        return path, encoding, warnings
 
     try:
         ri = intuit_rows(path)
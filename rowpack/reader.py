@@ -8,7 +8,83 @@
 import base
 import msgpack
 import struct
-from util import decode_obj
+from bisect import bisect_right
+from itertools import islice
+from util import decode_ext, meta_unpack_hooks, unpack_hooks, project_rows, rows_to_columns, rebatch, LazyDict, \
+    unpack_index, index_sort_key
+from compression import decompress, DEFAULT_CODEC
+from columnar import decode_columns, columns_to_rows
+from zonemaps import decode_zone_maps, zone_may_match, filter_rows, ops
+from functools import partial
+
+try:
+    buffer
+except NameError:  # Python 3
+    def buffer(obj, offset, size):
+        return memoryview(obj)[offset:offset + size]
+
+
+def _decode_sliced_columns(data, codec, positions, rows_slice, version):
+    """Decode a columnar block, keeping only the rows in rows_slice, a (start, stop) tuple"""
+
+    n_rows, lengths, columns = decode_columns(data, codec, positions, version)
+
+    if rows_slice is not None:
+        i, j = rows_slice
+        columns = [c[i:j] for c in columns]
+        lengths = lengths[i:j] if lengths is not None else None
+        n_rows = len(range(n_rows)[i:j])
+
+    return n_rows, lengths, columns
+
+
+def decode_block(data, codec=DEFAULT_CODEC, positions=None, layout='rows', where=None, rows_slice=None,
+                 version=base.VERSION):
+    """Decompress and unpack the compressed data for one block, optionally keeping only the rows in
+    rows_slice, a (start, stop) tuple of positions in the block, then only the rows that match the where
+    predicates, then projecting the rows to the columns at the given positions. The version is the file
+    format version, which sets how dates and times are decoded. """
+
+    if where:
+        rows = filter_rows(decode_block(data, codec, None, layout, rows_slice=rows_slice, version=version), where)
+        return project_rows(rows, positions) if positions is not None else rows
+
+    if layout == 'columns':
+        n_rows, lengths, columns = _decode_sliced_columns(data, codec, positions, rows_slice, version)
+        return columns_to_rows(n_rows, columns, lengths if positions is None else None)
+
+    data = decompress(data, codec)
+
+    rows = msgpack.unpackb(data, use_list=False, encoding='utf-8', **unpack_hooks(version))
+
+    if rows_slice is not None:
+        rows = rows[rows_slice[0]:rows_slice[1]]
+
+    if positions is not None:
+        rows = project_rows(rows, positions)
+
+    return rows
+
+
+def decode_block_columns(data, codec=DEFAULT_CODEC, positions=None, layout='rows', where=None, rows_slice=None,
+                         version=base.VERSION):
+    """Like decode_block, but return a list of columns. For the columnar layout, only the columns
+    at the given positions are decompressed and unpacked. """
+
+    if layout == 'columns' and not where:
+        n_rows, lengths, columns = _decode_sliced_columns(data, codec, positions, rows_slice, version)
+        return columns
+
+    rows = decode_block(data, codec, positions, layout, where, rows_slice, version)
+
+    return rows_to_columns(rows, len(positions) if positions is not None else None)
+
+
+def _call(args):
+    """Call a decoding function on block data, for mapping over a process pool"""
+    f, data = args
+    return f(data)
+
 
 class RowpackReader(object):
 
@@ -17,9 +93,26 @@ class RowpackReader(object):
     FILE_HEADER_FORMAT = base.FILE_HEADER_FORMAT
     FILE_HEADER_FORMAT_SIZE = base.FILE_HEADER_FORMAT_SIZE
 
-    def __init__(self, path, mode='rb'):
+    def __init__(self, path, mode='rb', workers=None, columns=None, where=None, mmap=False):
+        """
+
+        :param path: Path to the rowpack file
+        :param mode: File mode
+        :param workers: If set, decode blocks in a pool of this many processes while iterating
+        :param columns: If set, a list of column names or positions. Rows will have only these columns.
+        :param where: If set, a list of (column, op, value) predicates. Iteration will return only the
+            rows that match all of them, skipping blocks that the zone maps show can't match.
+        :param mmap: If True, memory map the file and decode blocks directly from the mapped pages, without
+            copying them into a read buffer. Best with files written with the 'none' codec, which can be
+            unpacked without decompressing, so repeated scans of a file in the page cache do almost no work.
+        """
         self.path = path
         self.mode = mode
+        self.workers = workers
+        self.columns = columns
+        self._positions = None
+        self.where = where
+        self._where = []
 
         self.magic = self.MAGIC
         self.version = self.VERSION
@@ -30,10 +123,38 @@ class RowpackReader(object):
         self.meta_end = 0
 
         self._fh = None
+        self._mmap = None
+        self.use_mmap = mmap
         self.unpacker = None
 
         self.meta = {}
 
+        # Index of the row blocks, each a tuple of (offset, length, first row, number of rows).
+        # Empty for version 2 files, which have a single compressed stream
+        self.blocks = []
+        self._block_starts = []
+        self._block_cache = (None, None)
+
+        self.codec = DEFAULT_CODEC
+        self.level = None
+        self.layout = 'rows'
+
+        # Per block, per column, (min, max, null count). For files with sectioned metadata, loaded when
+        # first used
+        self._zonemaps = []
+
+        # Sectioned metadata, section name to (offset, length)
+        self._sections = {}
+        self._uvalues = None
+
+        # Column name to the index of the column, or, for sectioned metadata, a function that loads it
+        self._indexes = {}
+
+        # For sectioned metadata, column name to the sort keys of the first values of the index pages and the
+        # (offset, length) of each page, and (column name, page number) to the pages that have been read
+        self._index_tables = {}
+        self._index_pages = {}
+
         self.open()
 
     def open(self):
@@ -45,8 +166,23 @@ class RowpackReader(object):
 
             self.read_meta()
 
+            if self.use_mmap and self.blocks:
+                import mmap
+
+                self._mmap = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+            if self.columns is not None:
+                self._positions = self.column_positions(self.columns)
+
+            if self.where:
+                self._where = self._resolve_where(self.where)
+
 
     def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
         if self._fh is not None:
 
             self._fh.close()
@@ -64,10 +200,16 @@ class RowpackReader(object):
             raise RowpackFormatError("Didn't get correct magic header: '{}' "\
                                      .format(self.magic.decode('utf8','replace').encode('ascii', 'replace')))
 
+        if self.version > self.VERSION:
+            raise RowpackFormatError("File version {} is newer than the latest supported version, {}"
+                                     .format(self.version, self.VERSION))
+
 
     def read_meta(self):
         from rowpack import Schema
-        import binascii
+
+        if self.version >= base.SECTIONED_META_VERSION:
+            return self.read_sections()
 
         curr = self._fh.tell()
 
@@ -79,13 +221,188 @@ class RowpackReader(object):
 
         assert len(b) == self.meta_end-self.data_end, self.path
 
-        d = msgpack.unpackb(b, encoding='utf-8')
+        d = msgpack.unpackb(b, encoding='utf-8', **meta_unpack_hooks(self.version))
 
         self.meta = d['meta']
         self.schema = Schema.from_rows(d['schema'])
+        self.blocks = [tuple(block) for block in d.get('blocks', [])]
+        self._block_starts = [block[2] for block in self.blocks]
+
+        codec = d.get('codec', {})
+        self.codec = codec.get('name', DEFAULT_CODEC)
+        self.level = codec.get('level')
+        self.layout = d.get('layout', 'rows')
+        self.zonemaps = decode_zone_maps(d.get('zonemaps', []))
+
+        self._indexes = {name: unpack_index(entries) for name, entries in d.get('indexes', {}).items()}
+
+        self._fh.seek(curr)
+
+    def read_sections(self):
+        """Read the section table of sectioned metadata, and the core section. Other sections are read
+        when they are used"""
+        from rowpack import Schema
+
+        curr = self._fh.tell()
+
+        self._fh.seek(self.data_end)
+
+        table_len, = base.SECTION_TABLE_FORMAT.unpack(self._fh.read(base.SECTION_TABLE_FORMAT.size))
+
+        table = msgpack.unpackb(self._fh.read(table_len), encoding='utf-8')
+
+        start = self.data_end + base.SECTION_TABLE_FORMAT.size + table_len
+
+        self._sections = {name: (start + offset, length) for name, offset, length in table}
+
+        d = self.read_section('core')
+
+        self.meta = LazyDict(d['meta'], {name[len('meta:'):]: partial(self.read_section, name)
+                                         for name in self._sections if name.startswith('meta:')})
+
+        self.schema = Schema.from_rows(d['schema'])
+
+        if 'uvalues' in self._sections:
+            for i, c in enumerate(self.schema):
+                c._uvalues_loader = partial(self._column_uvalues, i)
+
+        self.blocks = [tuple(block) for block in d.get('blocks', [])]
+        self._block_starts = [block[2] for block in self.blocks]
+
+        codec = d.get('codec', {})
+        self.codec = codec.get('name', DEFAULT_CODEC)
+        self.level = codec.get('level')
+        self.layout = d.get('layout', 'rows')
+
+        self._zonemaps = None
+
+        self._indexes = {name[len('index:'):]: partial(self._read_index, name[len('index:'):])
+                         for name in self._sections if name.startswith('index:')}
+        self._index_tables = {}
+        self._index_pages = {}
 
         self._fh.seek(curr)
 
+    def read_section(self, name, start=0, length=None):
+        """Read and unpack a metadata section, or, given a start and length, a part of it. If the reader is
+        closed, the file is opened again"""
+
+        offset, section_length = self._sections[name]
+
+        offset += start
+        length = section_length - start if length is None else length
+
+        fh = self._fh if self._fh is not None else open(self.path, 'rb')
+
+        try:
+            fh.seek(offset)
+            b = fh.read(length)
+        finally:
+            if fh is not self._fh:
+                fh.close()
+
+        return msgpack.unpackb(b, encoding='utf-8', ext_hook=decode_ext)
+
+    def _column_uvalues(self, i):
+
+        if self._uvalues is None:
+            self._uvalues = self.read_section('uvalues')
+
+        return self._uvalues[i] if i < len(self._uvalues) else None
+
+    @property
+    def zonemaps(self):
+        if self._zonemaps is None:
+            if 'zonemaps' in self._sections:
+                self._zonemaps = decode_zone_maps(self.read_section('zonemaps'))
+            else:
+                self._zonemaps = []
+
+        return self._zonemaps
+
+    @zonemaps.setter
+    def zonemaps(self, v):
+        self._zonemaps = v
+
+    def _read_index(self, name):
+        """Read all of the pages of the index of a column"""
+
+        index = {}
+
+        for v, start, length in self.read_section('index:' + name):
+            index.update(unpack_index(self.read_section('index_pages:' + name, start, length)))
+
+        return index
+
+    def _index_locations(self, name, value):
+        """Return the (block, offset) of each row with the value in the index of a column. If the index
+        hasn't been loaded, only the page that would have the value is read. """
+
+        index = self._indexes[name]
+
+        if not callable(index):
+            return index.get(value, [])
+
+        if name not in self._index_tables:
+            table = self.read_section('index:' + name)
+            self._index_tables[name] = ([index_sort_key(v) for v, start, length in table],
+                                        [(start, length) for v, start, length in table])
+
+        keys, pages = self._index_tables[name]
+
+        n = bisect_right(keys, index_sort_key(value)) - 1
+
+        if n < 0:
+            return []
+
+        if (name, n) not in self._index_pages:
+            self._index_pages[(name, n)] = unpack_index(self.read_section('index_pages:' + name, *pages[n]))
+
+        return self._index_pages[(name, n)].get(value, [])
+
+    def index(self, c):
+        """Return the index of a column, given by name or position, as a dict of value to a list of
+        (block, offset) tuples, or None if the column isn't indexed"""
+
+        name = self.schema[self.column_positions([c])[0]].name
+
+        index = self._indexes.get(name)
+
+        if callable(index):
+            index = self._indexes[name] = index()
+
+        return index
+
+    @property
+    def indexes(self):
+        """A dict of all of the column indexes, by column name"""
+        return {name: self.index(name) for name in list(self._indexes)}
+
+    def lookup(self, c, value):
+        """Return a list of the rows where the value of column c, given by name or position, is equal to value.
+        If the column is indexed, with fileops.build_index, only the blocks that have the rows are read, and, in
+        files with sectioned metadata, only the index page that would have the value. Otherwise, the blocks
+        that the zone maps show may have the value are scanned. """
+
+        name = self.schema[self.column_positions([c])[0]].name
+
+        if name not in self._indexes:
+            return list(self.filter(c, '=', value))
+
+        return [self._cached_block(n)[offset] for n, offset in self._index_locations(name, value)]
+
+    def load_metadata(self):
+        """Load all of the metadata sections that are loaded only when used"""
+
+        if isinstance(self.meta, LazyDict):
+            self.meta.load_all()
+
+        for c in self.schema:
+            c.uvalues
+
+        self.zonemaps
+        self.indexes
+
     def read(self, size=None):
         """Read from the compressed section of the file"""
 
@@ -94,8 +411,31 @@ class RowpackReader(object):
         else:
             return self._zfh.read()
 
+    def column_positions(self, columns):
+        """Convert a list of column names or positions to a list of positions"""
+        from .exceptions import RowpackError
+
+        headers = self.schema.headers
+
+        positions = []
+        for c in columns:
+            if isinstance(c, int):
+                positions.append(c)
+            else:
+                try:
+                    positions.append(headers.index(c))
+                except ValueError:
+                    raise RowpackError("No column named '{}' in {}".format(c, self.path))
+
+        return positions
+
     @property
     def headers(self):
+        """The column names, or just the names of the projected columns, if columns was set"""
+        if self._positions is not None:
+            headers = self.schema.headers
+            return [headers[i] if i < len(headers) else None for i in self._positions]
+
         return self.schema.headers
 
     def __enter__(self):
@@ -115,21 +455,389 @@ class RowpackReader(object):
 
         zfh = GzipFile(fileobj=self._fh, compresslevel=9, end_of_data=self.data_end)  # Compressor for writing rows
 
-        unpacker = msgpack.Unpacker(zfh, object_hook=decode_obj,
-                                    use_list=False,
-                                    encoding='utf-8')
+        unpacker = msgpack.Unpacker(zfh, use_list=False,
+                                    encoding='utf-8', **unpack_hooks(self.version))
 
         return zfh, unpacker
 
-    def __iter__(self):
+    def read_block_data(self, n):
+        """Return the compressed data for a single block. If the file is memory mapped, this is a
+        buffer over the mapped pages, not a copy"""
+
+        offset, length, first_row, n_rows = self.blocks[n]
+
+        if self._mmap is not None:
+            return buffer(self._mmap, offset, length)
+
+        self._fh.seek(offset)
+
+        return self._fh.read(length)
+
+    def read_block(self, n):
+        """Decompress and unpack a single block, returning a tuple of rows"""
+
+        return decode_block(self.read_block_data(n), self.codec, self._positions, self.layout, version=self.version)
+
+    def read_block_columns(self, n, positions=None):
+        """Decode a single block and return a list of columns, for the given positions, or for the
+        reader's columns, or for all columns. """
+
+        if positions is None:
+            positions = self._positions
+
+        return decode_block_columns(self.read_block_data(n), self.codec, positions, self.layout, version=self.version)
+
+    def column(self, c):
+        """Generate all of the values of a single column, given by name or position. For files with the
+        columnar layout, only that column is decompressed and unpacked. """
+
+        positions = self.column_positions([c])
+
+        if not self.blocks:
+            zfh, unpacker = self._unpacker()
+
+            for rows in unpacker:
+                for row in project_rows(rows, positions):
+                    yield row[0]
+
+            zfh.close()
+            return
+
+        for n in range(len(self.blocks)):
+            for v in self.read_block_columns(n, positions)[0]:
+                yield v
+
+    def _pool_blocks(self, decoders, ordered=True):
+        """Decode blocks in a process pool, given a list of (block number, decoding function) tuples.
+        The compressed data is read in windows of a few blocks per worker, so memory use is bounded no matter
+        how large the file is """
+        from multiprocessing import Pool, cpu_count
+
+        workers = self.workers or cpu_count()
+        window = workers * 4
+
+        pool = Pool(workers)
+        map_f = pool.imap if ordered else pool.imap_unordered
+
+        try:
+            for start in range(0, len(decoders), window):
+                # Buffers over a memory map can't be pickled, so they are copied for the workers
+                args = [(f, bytes(self.read_block_data(n))) for n, f in decoders[start:start + window]]
+
+                for rows in map_f(_call, args):
+                    yield rows
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _resolve_where(self, where):
+        """Convert the column names in a list of (column, op, value) predicates to positions"""
+        from .exceptions import RowpackError
+
+        resolved = []
+
+        for c, op, value in where:
+            if op not in ops:
+                raise RowpackError("Unknown operator '{}'; must be one of: {}".format(op, ' '.join(sorted(ops))))
+
+            resolved.append((self.column_positions([c])[0], op, value))
+
+        return resolved
+
+    def block_may_match(self, n, where):
+        """Return False if the zone maps show that block n has no rows that match the
+        predicates, a list of (position, op, value) tuples"""
+
+        zm = self.zonemaps[n] if n < len(self.zonemaps) else None
+
+        if zm is None:
+            return True
+
+        n_rows = self.blocks[n][3]
+
+        return all(zone_may_match(zm[pos] if pos < len(zm) else None, n_rows, op, value)
+                   for pos, op, value in where)
+
+    def _legacy_blocks(self, where, as_columns, positions, start, stop):
+        """Generate blocks from a version 2 file, which has no block index"""
 
         zfh, unpacker = self._unpacker()
 
+        first_row = 0
+
         for rows in unpacker:
+            first_row += len(rows)
+
+            if first_row - len(rows) >= stop:
+                break
+            elif first_row <= start:
+                continue
+            elif first_row - len(rows) < start or first_row > stop:
+                rows = rows[max(start - (first_row - len(rows)), 0):stop - (first_row - len(rows))]
+
+            if where:
+                rows = filter_rows(rows, where)
+
+            if positions is not None:
+                rows = project_rows(rows, positions)
+
+            if as_columns:
+                yield rows_to_columns(rows, len(positions) if positions is not None else None)
+            else:
+                yield rows
+
+        zfh.close()
+
+    def iter_blocks(self, parallel=False, where=None, as_columns=False, columns=None, start=None, stop=None):
+        """Generate the decoded blocks of the file, each a tuple of rows. If parallel is True, decode
+        the blocks in a process pool and yield them in the order they finish, which is not
+        necessarily the file order.
+
+        If where is a list of (column, op, value) predicates, in addition to any given to the
+        constructor, yield only the rows that match all of the predicates, and skip the blocks that
+        can't have any such rows. Null values never match.
+
+        If as_columns is True, yield each block as a list of columns, each a list of values, instead
+        of a tuple of rows.
+
+        If columns is set, it overrides the columns given to the constructor.
+
+        If start or stop are set, only the rows from start up to, but not including, stop are
+        returned, and only the blocks that hold them are read.
+        """
+
+        where = self._where + self._resolve_where(where or [])
+
+        positions = self.column_positions(columns) if columns is not None else self._positions
+
+        start, stop, _ = slice(start, stop).indices(self.n_rows)
+
+        if not self.blocks:
+            blocks = self._legacy_blocks(where, as_columns, positions, start, stop)
+
+        else:
+            decode_f = partial(decode_block_columns if as_columns else decode_block,
+                               codec=self.codec, positions=positions, layout=self.layout, where=where,
+                               version=self.version)
+
+            decoders = []
+
+            for n, (offset, length, first_row, n_rows) in enumerate(self.blocks):
+                if first_row + n_rows <= start or first_row >= stop:
+                    continue
+
+                if where and not self.block_may_match(n, where):
+                    continue
+
+                if first_row < start or first_row + n_rows > stop:
+                    decoders.append((n, partial(decode_f, rows_slice=(max(start - first_row, 0), stop - first_row))))
+                else:
+                    decoders.append((n, decode_f))
+
+            if parallel or self.workers:
+                blocks = self._pool_blocks(decoders, ordered=not parallel)
+            else:
+                blocks = (f(self.read_block_data(n)) for n, f in decoders)
+
+        for block in blocks:
+            if not where or (block and (not as_columns or block[0])):
+                yield block
+
+    def iter_batches(self, size, as_columns=False, where=None, columns=None):
+        """Like iter_blocks, but yield batches of exactly size rows, except for the last one"""
+
+        return rebatch(self.iter_blocks(where=where, as_columns=as_columns, columns=columns), size, as_columns)
+
+    def _array_columns(self, columns):
+        """Return the positions, field names and NumPy dtypes of the columns for array conversion"""
+        from arrays import numpy_dtype, field_names
+
+        if columns is not None:
+            positions = self.column_positions(columns)
+        elif self._positions is not None:
+            positions = self._positions
+        else:
+            positions = list(range(len(self.schema.columns) or self.n_cols or self._row_width()))
+
+        schema_columns = self.schema.columns
+        headers = self.schema.headers
+
+        names = field_names([headers[i] if i < len(headers) else None for i in positions])
+        dtypes = [numpy_dtype(schema_columns[i].python_type) if i < len(schema_columns) else 'O'
+                  for i in positions]
+
+        return positions, names, dtypes
+
+    def _row_width(self):
+        """The number of values in the longest row of the first block, for files written without a schema"""
+        return max([len(row) for row in next(self.iter_blocks(), ())] or [0])
+
+    def _iter_column_arrays(self, positions, dtypes, batch_rows=None, where=None, start=None, stop=None):
+        """Generate a list of NumPy arrays, one per column, for each block or batch of batch_rows rows"""
+        from arrays import column_array
+
+        if batch_rows:
+            blocks = rebatch(self.iter_blocks(as_columns=True, where=where, columns=positions, start=start, stop=stop),
+                             batch_rows, as_columns=True)
+        else:
+            blocks = self.iter_blocks(as_columns=True, where=where, columns=positions, start=start, stop=stop)
+
+        for block in blocks:
+            yield [column_array(c, dt) for c, dt in zip(block, dtypes)]
+
+    def _concat_column_arrays(self, positions, dtypes, where=None, start=None, stop=None):
+        """Return one array per column for all of the rows. Blocks are converted to arrays one at a time,
+        so no more than one block is held as Python objects."""
+        import numpy as np
+        from arrays import column_array
+
+        arrays = [[] for _ in positions]
+
+        for block in self._iter_column_arrays(positions, dtypes, where=where, start=start, stop=stop):
+            for a, ca in zip(arrays, block):
+                a.append(ca)
+
+        return [np.concatenate(a) if a else column_array([], dt) for a, dt in zip(arrays, dtypes)]
+
+    def iter_numpy(self, batch_rows=None, columns=None, data_rows=True, where=None):
+        """Generate NumPy structured arrays, one per block, or one per batch_rows rows, with fields
+        for all of the columns, or for the given columns. Field dtypes come from the schema datatypes;
+        integer columns with nulls become float64, and columns whose values don't fit the schema type
+        become objects. If data_rows is True, only the data rows given by the rowspec are included. """
+        from arrays import structured_array
+
+        positions, names, dtypes = self._array_columns(columns)
+
+        start, stop = self.data_range() if data_rows else (None, None)
+
+        for arrays in self._iter_column_arrays(positions, dtypes, batch_rows, where, start, stop):
+            yield structured_array(names, arrays)
+
+    def to_numpy(self, columns=None, data_rows=True, where=None):
+        """Return the file, or the given columns, as a single NumPy structured array. If data_rows is True,
+        only the data rows given by the rowspec are included, so the header and comment rows don't turn
+        every field into objects. """
+        from arrays import structured_array
+
+        positions, names, dtypes = self._array_columns(columns)
+
+        start, stop = self.data_range() if data_rows else (None, None)
+
+        return structured_array(names, self._concat_column_arrays(positions, dtypes, where, start, stop))
+
+    def data_range(self):
+        """Return the (start, stop) range of the data rows, from the rowspec, or all rows if there is no rowspec.
+        The rowspec end is the last data row, so stop is one past it. """
+
+        rs = self.meta.get('rowspec') or {}
+
+        start = rs.get('start') or 0
+        end = rs.get('end')
+
+        stop = int(end) + 1 if end not in (None, '') else self.n_rows
+
+        return int(start), min(stop, self.n_rows)
+
+    def _dataframe(self, names, arrays):
+        import pandas as pd
+
+        return pd.DataFrame(dict(zip(names, arrays)), columns=names)
+
+    def to_dataframe(self, columns=None, data_rows=True, where=None):
+        """Return the file, or the given columns, as a Pandas DataFrame, with column dtypes from the schema,
+        as for to_numpy. If data_rows is True, only the data rows given by the rowspec are included, so the
+        header and comment rows don't turn every column into objects. """
+
+        positions, names, dtypes = self._array_columns(columns)
+
+        start, stop = self.data_range() if data_rows else (None, None)
+
+        return self._dataframe(names, self._concat_column_arrays(positions, dtypes, where, start, stop))
+
+    def iter_dataframes(self, chunksize, columns=None, data_rows=True, where=None):
+        """Like to_dataframe, but generate DataFrames of chunksize rows, except for the last one. The
+        index of each frame starts at 0. """
+
+        positions, names, dtypes = self._array_columns(columns)
+
+        start, stop = self.data_range() if data_rows else (None, None)
+
+        for arrays in self._iter_column_arrays(positions, dtypes, chunksize, where, start, stop):
+            yield self._dataframe(names, arrays)
+
+    def filter(self, c, op, value):
+        """Generate the rows where the value of column c matches the predicate. For
+        instance, filter('year', '>=', 2010).  Null values never match. """
+
+        for rows in self.iter_blocks(where=[(c, op, value)]):
             for row in rows:
                 yield row
 
-        zfh.close()
+    def _cached_block(self, n):
+        """Like read_block, but keep the last block, for repeated random access"""
+
+        if self._block_cache[0] != n:
+            self._block_cache = (n, self.read_block(n))
+
+        return self._block_cache[1]
+
+    def block_for_row(self, row_n):
+        """Return the number of the block that holds a row"""
+        return bisect_right(self._block_starts, row_n) - 1
+
+    def rows(self, start=None, stop=None):
+        """Generate the rows from start up to, but not including, stop, reading only
+        the blocks that hold them"""
+
+        start, stop, _ = slice(start, stop).indices(self.n_rows)
+
+        if not self.blocks:
+            # Version 2 files have no index, so we have to read from the start
+            for row in islice(self, start, stop):
+                yield row
+            return
+
+        if start >= stop:
+            return
+
+        for n in range(self.block_for_row(start), len(self.blocks)):
+            first_row = self.blocks[n][2]
+
+            if first_row >= stop:
+                break
+
+            block = self.read_block(n)
+
+            for row in block[max(start - first_row, 0):stop - first_row]:
+                yield row
+
+    def __getitem__(self, item):
+
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self.n_rows)
+            if step == 1:
+                return list(self.rows(start, stop))
+            else:
+                return [self[i] for i in range(start, stop, step)]
+
+        if item < 0:
+            item += self.n_rows
+
+        if not 0 <= item < self.n_rows:
+            raise IndexError('Row {} out of range for file with {} rows'.format(item, self.n_rows))
+
+        if not self.blocks:
+            return next(islice(self, item, None))
+
+        n = self.block_for_row(item)
+
+        return self._cached_block(n)[item - self.blocks[n][2]]
+
+    def __iter__(self):
+
+        for rows in self.iter_blocks():
+            for row in rows:
+                yield row
 
     @property
     def data_rows(self):
@@ -34,18 +34,36 @@ class Column(object):
             self.datatype = text_type(kwargs.get('datatype'))
 
         self.count = float(kwargs.get('count', 'nan'))
+        self.nulls = float(kwargs.get('nulls', 'nan'))
+        self.numerics = float(kwargs.get('numerics', 'nan'))  # Count of the numeric values, for the moments
         self.min = float(kwargs.get('min', 'nan'))
         self.mean = float(kwargs.get('mean', 'nan'))
         self.median = float(kwargs.get('median', kwargs.get('p50', 'nan')))
         self.max = float(kwargs.get('max', 'nan'))
         self.std = float(kwargs.get('std', 'nan'))
         self.nuniques = float(kwargs.get('nuniques', 'nan'))
-        self.uvalues = kwargs.get('uvalues', None)
+        self._uvalues = kwargs.get('uvalues', None)
+
+        # If set, a function that returns the uvalues, for readers that load them only when they are used
+        self._uvalues_loader = None
 
     def __str__(self):
 
         return "<col {} {} {}>".format(self.pos, self.name, self.datatype)
 
+    @property
+    def uvalues(self):
+        if self._uvalues_loader is not None:
+            self._uvalues = self._uvalues_loader()
+            self._uvalues_loader = None
+
+        return self._uvalues
+
+    @uvalues.setter
+    def uvalues(self, v):
+        self._uvalues_loader = None
+        self._uvalues = v
+
     @property
     def python_type(self):
         return types_map.get(self.datatype, binary_type)
@@ -53,8 +71,15 @@ class Column(object):
 
     @property
     def dict(self):
+        """The column's attributes. The uvalues are included only if they are loaded, so displaying a
+        schema doesn't read them from the file. Schema.to_rows includes them. """
+
+        d = {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
+
+        if self._uvalues_loader is None:
+            d['uvalues'] = self._uvalues
 
-        return self.__dict__
+        return d
 
 
 
@@ -88,7 +113,7 @@ class Schema(object):
         return [c.name for c in self.columns]
 
     def to_rows(self):
-        return [c.dict for c in self.columns]
+        return [dict(c.dict, uvalues=c.uvalues) for c in self.columns]
 
     def __iter__(self):
         return iter(self.columns)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE.txt
+
+"""
+
+Fixed size, mergeable summaries of a column, for statistics of columns with too many distinct values to
+count exactly:
+
+    - HyperLogLog, for the number of distinct values. With the default 2**12 registers, the relative
+      standard error is 1.04 / sqrt(2**12), about 1.6%.
+    - QuantileSketch, a hierarchy of compactors (Manku, Rajagopalan and Lindsay; Karnin, Lang and Liberty),
+      for the median and other quantiles. With k items per level, the rank of a returned quantile is within
+      n * log2(n / k) / k of the true rank, about 1.9% of n for the default k = 1024 and a billion values.
+      Random compaction offsets make the typical error much smaller.
+    - MisraGries, for the most common values. With k counters, each estimated count is at most
+      n / (k + 1) less than the true count, and any value with more than n / (k + 1) occurrences is kept.
+
+All of them can be pickled, and merged with another summary of the same size, so they can be computed
+over blocks in a process pool.
+
+"""
+
+import hashlib
+import random
+import struct
+from heapq import nlargest
+from math import log
+from six import text_type, binary_type
+
+_uint64 = struct.Struct('<Q')
+
+
+def _hash64(v):
+    """A 64 bit hash that is the same in every process, unlike hash() for strings in Python 3"""
+
+    if isinstance(v, text_type):
+        b = v.encode('utf-8')
+    elif isinstance(v, binary_type):
+        b = v
+    else:
+        b = repr(v).encode('utf-8')
+
+    return _uint64.unpack(hashlib.md5(b).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+    """Estimate the number of distinct values, in 2**p bytes. """
+
+    def __init__(self, p=12):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def add(self, v):
+        h = _hash64(v)
+
+        bits = 64 - self.p
+
+        # The first p bits pick the register, which records the highest position of the first 1 bit
+        # in the remaining bits
+        i = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+
+    def update(self, values):
+        for v in set(values):
+            self.add(v)
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError("Can't merge HyperLogLogs of different sizes")
+
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+        return self
+
+    def count(self):
+        m = self.m
+
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+
+        zeros = self.registers.count(b'\x00')
+
+        # Linear counting is more accurate for small cardinalities
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * log(float(m) / zeros)
+
+        return int(round(estimate))
+
+    __len__ = count
+
+
+class QuantileSketch(object):
+    """Approximate quantiles of a stream of orderable values, holding about k values per level, and
+    log2(n / k) levels. Level h holds values that each stand for 2**h of the original values. When a level
+    is full, it is sorted and every other value, starting at a random offset, is moved up a level. """
+
+    def __init__(self, k=1024, seed=None):
+        self.k = k
+        self.n = 0
+        self.levels = [[]]
+        self._random = random.Random(seed)
+
+    def add(self, v):
+        self.n += 1
+        self.levels[0].append(v)
+
+        if len(self.levels[0]) >= self.k:
+            self._compress()
+
+    def update(self, values):
+        self.n += len(values)
+        self.levels[0].extend(values)
+
+        if len(self.levels[0]) >= self.k:
+            self._compress()
+
+    def _compress(self):
+
+        h = 0
+
+        while h < len(self.levels):
+            if len(self.levels[h]) >= self.k:
+                if h + 1 == len(self.levels):
+                    self.levels.append([])
+
+                level = sorted(self.levels[h])
+
+                # An odd value out stays at this level, so the total weight is unchanged
+                keep = [level.pop()] if len(level) % 2 else []
+
+                self.levels[h + 1].extend(level[self._random.randint(0, 1)::2])
+                self.levels[h] = keep
+
+            h += 1
+
+    def merge(self, other):
+        if other.k != self.k:
+            raise ValueError("Can't merge quantile sketches of different sizes")
+
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+
+        for h, level in enumerate(other.levels):
+            self.levels[h].extend(level)
+
+        self.n += other.n
+
+        self._compress()
+
+        return self
+
+    def _weighted(self):
+        return sorted((v, 1 << h) for h, level in enumerate(self.levels) for v in level)
+
+    def quantile(self, q):
+        """Return the value at rank q * (n - 1), rounded down, such as the lower median for q = 0.5"""
+
+        if not self.n:
+            return None
+
+        rank = int(q * (self.n - 1))
+
+        items = self._weighted()
+
+        for v, w in items:
+            if rank < w:
+                return v
+            rank -= w
+
+        return items[-1][0]
+
+    def quantiles(self, qs):
+        return [self.quantile(q) for q in qs]
+
+    @property
+    def median(self):
+        return self.quantile(0.5)
+
+    def __getstate__(self):
+        d = dict(self.__dict__)
+        del d['_random']
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._random = random.Random()
+
+
+class MisraGries(object):
+    """Approximate counts of the most common values, with at most k counters. Values that aren't counted
+    have estimated counts of 0. """
+
+    def __init__(self, k=1000):
+        self.k = k
+        self.n = 0
+        self.counters = {}
+
+    def add(self, v, count=1):
+        self.n += count
+
+        counters = self.counters
+
+        if v in counters:
+            counters[v] += count
+        else:
+            counters[v] = count
+
+            if len(counters) > 2 * self.k:
+                self._reduce()
+
+    def update(self, values):
+        from collections import Counter
+
+        for v, c in Counter(values).items():
+            self.add(v, c)
+
+    def _reduce(self):
+        """Subtract the (k+1)th largest count from all of the counters, and drop those that aren't positive.
+        This is the merge step of Agarwal et al. To amortize the cost, it is done when there are more than 2k
+        counters, which keeps the error bound, because every reduction takes the same count from at least k+1
+        values."""
+
+        if len(self.counters) <= self.k:
+            return
+
+        cut = nlargest(self.k + 1, self.counters.values())[-1]
+
+        self.counters = dict((v, c - cut) for v, c in self.counters.items() if c > cut)
+
+    def merge(self, other):
+        for v, c in other.counters.items():
+            self.counters[v] = self.counters.get(v, 0) + c
+
+        self.n += other.n
+
+        self._reduce()
+
+        return self
+
+    def most_common(self, n=None):
+        items = sorted(self.counters.items(), key=lambda e: e[1], reverse=True)
+        return items[:n] if n is not None else items
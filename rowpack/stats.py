@@ -7,38 +7,106 @@
 """
 
 from . import RowpackReader, RowpackWriter
-from tableintuit import Stats, RowIntuiter, TypeIntuiter
+from colstats import ColumnStats
+from tableintuit import RowIntuiter, TypeIntuiter
 
-def run_stats(path, update=True):
+def block_stats(data, columns, sketches=False, uniques=True, **kwargs):
+    """Decode the compressed data for one block, and return a list of ColumnStats, one per column, given as
+    a list of (name, python type) tuples. The keyword arguments are passed to decode_block_columns. """
+    from reader import decode_block_columns
 
-    from tableintuit import Stats
-    from . import RowpackReader
+    stats = [ColumnStats(name, python_type, sketches, uniques) for name, python_type in columns]
 
-    with RowpackReader(path) as r:
-        stats_schema = [(c.name, c.python_type) for c in r.schema]
-        headers = r.headers
-        stats = Stats(stats_schema).run(dict(zip(headers, row)) for row in r)
+    for s, values in zip(stats, decode_block_columns(data, positions=list(range(len(columns))), **kwargs)):
+        s.add_values(values)
+
+    return stats
+
+
+def merge_stats(a, b):
+    """Merge two lists of ColumnStats for the same columns"""
+
+    if a is None:
+        return b
 
+    for sa, sb in zip(a, b):
+        sa.merge(sb)
+
+    return a
+
+
+def run_stats(path, update=True, workers=None, sketches=False):
+    """Compute the statistics of each column of the schema, and, if update is True, store them in the
+    schema columns. If workers is more than 1, blocks are processed in a pool of workers processes, and
+    the results merged. If sketches is True, the number of uniques, median and most common values are estimated with
+    fixed size sketches. Returns a dict of ColumnStats by column name. """
+    from collections import OrderedDict
+    from functools import partial
+
+    with RowpackReader(path, workers=workers) as r:
         schema = r.schema
+        columns = [(c.name, c.python_type) for c in schema]
+
+        stats = None
+
+        if workers and workers > 1 and len(r.blocks) > 1:
+            f = partial(block_stats, columns=columns, sketches=sketches, codec=r.codec, layout=r.layout, version=r.version)
+
+            for bs in r._pool_blocks([(n, f) for n in range(len(r.blocks))], ordered=False):
+                stats = merge_stats(stats, bs)
+
+        else:
+            for block in r.iter_blocks(as_columns=True, columns=list(range(len(columns)))):
+                bs = [ColumnStats(name, python_type, sketches) for name, python_type in columns]
+                for s, values in zip(bs, block):
+                    s.add_values(values)
+
+                stats = merge_stats(stats, bs)
+
+        if stats is None:
+            stats = [ColumnStats(name, python_type, sketches) for name, python_type in columns]
 
     if update:
         with RowpackWriter(path, 'r+b') as w:
-            for c in schema:
-                s = stats[c.name]
+            for c, s in zip(schema, stats):
+                s.update_column(c)
 
-                c.count = float(s.n)
-                c.nuniques = float(s.nuniques)
-                c.min = float(s.min if s.min is not None else 'nan')
-                c.mean = float(s.mean if s.mean is not None else 'nan')
-                c.median = float(s.p50 if s.p50 is not None else 'nan')
-                c.max = float(s.max if s.max is not None else 'nan')
-                c.std = float(s.stddev if s.stddev is not None else 'nan')
+            w.schema = schema
 
-                c.uvalues = s.uvalues
+    return OrderedDict((s.name, s) for s in stats)
 
-            w.schema = schema
 
-    return stats
+# Number of rows at the start of a file that are used for row and type intuition
+INTUIT_ROWS = 1000
+
+
+def intuit_row_types(rows):
+    """Run row intuition on a list of rows from the start of a file"""
+
+    ri = RowIntuiter()
+    ri.run(rows)
+
+    return ri
+
+
+def intuit_column_types(rows, rowspec=None):
+    """Run type intuition on the data rows of a list of rows from the start of a file"""
+    from tableintuit import SelectiveRowGenerator
+
+    srg = SelectiveRowGenerator(rows, **(rowspec or {}))
+
+    return TypeIntuiter().run(list(srg))
+
+
+def types_schema(ti):
+    """Return a Schema with the columns and types from a TypeIntuiter"""
+    from . import Schema
+
+    s = Schema()
+    for k, v in ti.columns.items():
+        s.add_column(name=v.header, datatype=v.resolved_type_name)
+
+    return s
 
 
 def intuit_rows(path, update=True):
@@ -46,9 +114,7 @@ def intuit_rows(path, update=True):
     from itertools import islice
 
     with RowpackReader(path) as r:
-
-        ri = RowIntuiter()
-        ri.run(list(islice(r, 1000)))
+        ri = intuit_row_types(list(islice(r, INTUIT_ROWS)))
 
     with RowpackWriter(path, 'r+b') as w:
         w.meta['rowspec'] = ri.spec
@@ -60,8 +126,6 @@ def intuit_rows(path, update=True):
 def intuit_types(path, update=True):
 
     from itertools import islice
-    from tableintuit import SelectiveRowGenerator
-    from . import Schema
 
     with RowpackReader(path) as r:
 
@@ -70,19 +134,11 @@ def intuit_types(path, update=True):
         else:
             rs = {}
 
-        rows = list(islice(r, 1000))
-
-        srg = SelectiveRowGenerator(rows, **rs)
-
-        ti = TypeIntuiter().run(list(srg))
+        ti = intuit_column_types(list(islice(r, INTUIT_ROWS)), rs)
 
     if update:
         with RowpackWriter(path, 'r+b') as w:
-            s = Schema()
-            for k,v in ti.columns.items():
-                s.add_column(name = v.header, datatype = v.resolved_type_name)
-
-            w.schema = s
+            w.schema = types_schema(ti)
 
             w.meta['types'] = list(ti.to_rows())
 
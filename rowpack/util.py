@@ -6,6 +6,10 @@
 """
 
 import datetime
+import struct
+from collections import MutableMapping
+from msgpack import ExtType
+from six import integer_types, string_types, binary_type, text_type
 
 
 def encode_obj(obj):
@@ -43,4 +47,362 @@ def decode_obj(obj):
     else:
         raise Exception('Unknown type on decode: {} '.format(obj))
 
-    return obj
\ No newline at end of file
+    return obj
+
+def decode_meta_obj(obj):
+    """Like decode_obj, but return dicts that aren't encoded dates or times unchanged"""
+
+    if '__datetime__' in obj or '__date__' in obj or '__time__' in obj:
+        return decode_obj(obj)
+
+    return obj
+
+# Msgpack extension type codes for dates and times, used from format version 5. The values are packed
+# calendar fields, which decode with a single struct unpack and constructor call. As with encode_obj,
+# timezones are not stored.
+EXT_DATETIME = 1
+EXT_DATE = 2
+EXT_TIME = 3
+
+EXT_TYPE_VERSION = 5
+
+_datetime_struct = struct.Struct('>HBBBBBI')  # year, month, day, hour, minute, second, microsecond
+_date_struct = struct.Struct('>HBB')
+_time_struct = struct.Struct('>BBBI')
+
+
+def _ext(code, data):
+    # ExtType.__new__ checks its arguments in Python, which is slow for every value of a column
+    return tuple.__new__(ExtType, (code, data))
+
+
+def _encode_datetime(obj):
+    return _ext(EXT_DATETIME, _datetime_struct.pack(obj.year, obj.month, obj.day, obj.hour,
+                                                    obj.minute, obj.second, obj.microsecond))
+
+
+def _encode_date(obj):
+    return _ext(EXT_DATE, _date_struct.pack(obj.year, obj.month, obj.day))
+
+
+def _encode_time(obj):
+    return _ext(EXT_TIME, _time_struct.pack(obj.hour, obj.minute, obj.second, obj.microsecond))
+
+
+# Extension type encoders, by the exact type of the value. Subclasses are handled by encode_ext
+ext_encoders = {
+    datetime.datetime: _encode_datetime,
+    datetime.date: _encode_date,
+    datetime.time: _encode_time,
+}
+
+
+def encode_ext(obj):
+    """Like encode_obj, but encode dates and times as compact msgpack extension types"""
+
+    try:
+        if type(obj) in ext_encoders:
+            return ext_encoders[type(obj)](obj)
+        elif isinstance(obj, datetime.datetime):
+            return _encode_datetime(obj)
+        elif isinstance(obj, datetime.date):
+            return _encode_date(obj)
+        elif isinstance(obj, datetime.time):
+            return _encode_time(obj)
+    except (ValueError, TypeError, struct.error):
+        pass  # Such as Pandas 'NaT', which encode_obj handles
+
+    return encode_obj(obj)
+
+
+def encode_typed(obj):
+    """Msgpack default function for writers with a schema. Dates and times are encoded as extension
+    types, with the encoder looked up by the exact type of the value. Any other value that msgpack can't
+    pack natively is an error, rather than being converted to a string as encode_obj does. """
+
+    try:
+        return ext_encoders[type(obj)](obj)
+    except KeyError:
+        pass
+
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return encode_ext(obj)
+
+    raise TypeError("Can't encode value of type {}".format(type(obj).__name__))
+
+
+def untyped_values(rows, headers=None, first_row=0):
+    """Return a list of (row number, column name, value) for the values in rows that encode_typed
+    can't encode. Only the top level values of each row are checked. """
+
+    untyped = []
+
+    for i, row in enumerate(rows):
+        for j, v in enumerate(row):
+            if not isinstance(v, packable_types):
+                name = headers[j] if headers and j < len(headers) else j
+                untyped.append((first_row + i, name, v))
+
+    return untyped
+
+
+def decode_ext(code, data):
+    """Msgpack ext_hook for the extension types written by encode_ext"""
+
+    if code == EXT_DATETIME:
+        return datetime.datetime(*_datetime_struct.unpack(data))
+    elif code == EXT_DATE:
+        return datetime.date(*_date_struct.unpack(data))
+    elif code == EXT_TIME:
+        return datetime.time(*_time_struct.unpack(data))
+    else:
+        return ExtType(code, data)
+
+
+# Values that msgpack packs natively, or that encode_typed encodes
+packable_types = (type(None), bool, float, tuple, list, dict, ExtType, datetime.date, datetime.time) + \
+                 integer_types + string_types + (binary_type,)
+
+
+def pack_default(version):
+    """Return the msgpack default function for encoding dates and times in a file of the given version"""
+    return encode_ext if version >= EXT_TYPE_VERSION else encode_obj
+
+
+def unpack_hooks(version):
+    """Return the msgpack unpacking keyword arguments for decoding dates and times in a file of the
+    given version. Older versions encode them as dicts, so they need an object_hook. """
+    return {'ext_hook': decode_ext} if version >= EXT_TYPE_VERSION else {'object_hook': decode_obj}
+
+
+def meta_unpack_hooks(version):
+    """Return the msgpack unpacking keyword arguments for the metadata of a file of the given version. In
+    older versions, dates are encoded as dicts, which must be decoded while unpacking, because the column
+    statistics store dates as keys of the uvalues maps, and a dict can't be a key. """
+    return {'ext_hook': decode_ext} if version >= EXT_TYPE_VERSION else \
+        {'ext_hook': decode_ext, 'object_hook': decode_meta_obj}
+
+
+def project_rows(rows, positions):
+    """Return a tuple of rows that have only the values at the given positions. Rows that are too short,
+    such as comment rows, get None for the missing values"""
+    from operator import itemgetter
+
+    getter = itemgetter(*positions)
+
+    try:
+        if len(positions) == 1:
+            return tuple((getter(row),) for row in rows)
+        else:
+            return tuple(map(getter, rows))
+    except IndexError:
+        return tuple(tuple(row[i] if i < len(row) else None for i in positions) for row in rows)
+
+
+def rows_to_columns(rows, n_cols=None):
+    """Transpose a block of rows to a list of columns. Short rows are padded with None"""
+
+    if n_cols is None:
+        n_cols = max(len(row) for row in rows) if rows else 0
+
+    if all(len(row) == n_cols for row in rows):
+        return [list(c) for c in zip(*rows)] if rows else [[] for _ in range(n_cols)]
+
+    return [[row[i] if i < len(row) else None for row in rows] for i in range(n_cols)]
+
+
+def rebatch(blocks, size, as_columns=False):
+    """Regroup blocks of rows, or blocks of columns, into batches of size rows. The last batch may be smaller"""
+
+    if as_columns:
+        length = lambda b: len(b[0]) if b else 0
+        take = lambda b, i, j: [c[i:j] for c in b]
+        join = lambda a, b: [list(x) + list(y) for x, y in zip(a, b)]
+    else:
+        length = len
+        take = lambda b, i, j: b[i:j]
+        join = lambda a, b: tuple(a) + tuple(b)
+
+    buf = None
+
+    for block in blocks:
+        n = length(block)
+        i = 0
+
+        if buf is not None:
+            i = min(size - length(buf), n)
+            buf = join(buf, take(block, 0, i))
+
+            if length(buf) < size:
+                continue
+
+            yield buf
+            buf = None
+
+        while n - i >= size:
+            yield take(block, i, i + size)
+            i += size
+
+        if i < n:
+            buf = take(block, i, n)
+
+    if buf is not None:
+        yield buf
+
+
+def index_values(index, values, block):
+    """Add the values of a column in a block to an index, a dict of value to a list of (block, offset) tuples.
+    Nulls, NaNs, which aren't equal to themselves, and values that can't be dict keys, aren't indexed. """
+
+    for offset, v in enumerate(values):
+        if v is None or v != v:
+            continue
+
+        try:
+            index.setdefault(v, []).append((block, offset))
+        except TypeError:
+            pass
+
+
+def pack_index(index):
+    """Convert an index to a list of [value, [block, offset, ...]] entries, for storing in the metadata. A list
+    rather than a map, so values such as dates in older versions, which unpack to dicts, can be keys. """
+
+    return [[v, [i for loc in locs for i in loc]] for v, locs in index.items()]
+
+
+def unpack_index(entries):
+    """Convert the list of entries from pack_index back to an index"""
+
+    return {v: list(zip(locs[::2], locs[1::2])) for v, locs in entries}
+
+
+_index_type_ranks = {}
+
+
+def index_type_rank(v):
+    """Return a tuple that orders the type of an index value. Values are grouped by type, with all numbers
+    together and all strings together, because values of some different types, such as dates and strings,
+    can't be compared. """
+    from numbers import Number
+
+    t = type(v)
+
+    if t not in _index_type_ranks:
+        if isinstance(v, Number):
+            _index_type_ranks[t] = (0, '')
+        elif isinstance(v, string_types):
+            _index_type_ranks[t] = (1, '')
+        else:
+            _index_type_ranks[t] = (2, t.__name__)
+
+    return _index_type_ranks[t]
+
+
+def index_sort_key(v):
+    """Sort key for index values, in the order of page_index"""
+    return index_type_rank(v) + (v,)
+
+
+# Types of index values that unpack to a type of the same rank, in index_type_rank
+index_stable_types = frozenset(integer_types + (text_type, binary_type, bool, float, datetime.datetime,
+                                                 datetime.date, datetime.time))
+
+
+def page_index(index, page_size, repack=None):
+    """Convert an index to a list of entries, as from pack_index, sorted by value, and split them into pages
+    of page_size entries. Returns the list of the first value of each page, and the list of pages.
+
+    Packing can change the type of a value, such as a Decimal to a string, so readers would look for it in
+    the wrong page. If repack is given, it is called with the entries that have values of other types than
+    index_stable_types, and returns them as readers unpack them. NaNs, which can't be sorted, are left out. """
+
+    def values_by_type():
+        d = {}
+        for v in index:
+            if v != v:
+                continue
+            d.setdefault(type(v), []).append(v)
+        return d
+
+    by_type = values_by_type()
+
+    unstable = [t for t in by_type if t not in index_stable_types] if repack is not None else []
+
+    if unstable:
+        index = dict(index)
+
+        for v, locs in repack(pack_index({v: index.pop(v) for t in unstable for v in by_type[t]})):
+            index.setdefault(v, []).extend(zip(locs[::2], locs[1::2]))
+
+        by_type = values_by_type()
+
+    groups = {}
+    for values in by_type.values():
+        groups.setdefault(index_type_rank(values[0]), []).extend(values)
+
+    entries = [[v, [i for loc in index[v] for i in loc]]
+               for rank in sorted(groups) for v in sorted(groups[rank])]
+
+    pages = [entries[i:i + page_size] for i in range(0, len(entries), page_size)]
+
+    return [page[0][0] for page in pages], pages
+
+
+class LazyDict(MutableMapping):
+    """A mapping with some values that are loaded by a function the first time they are accessed, such as
+    large metadata sections. The keys are all present without loading. Methods that return values, and
+    the load_all() method, load the values that haven't been loaded. It isn't a dict subclass, so copies
+    made with dict(), update() or ** get the values through __getitem__, and include the unloaded ones. """
+
+    def __init__(self, d=None, loaders=None):
+        self._d = dict(d or {})
+        self._loaders = dict(loaders or {})
+
+    def _load(self, key):
+        self._d[key] = self._loaders.pop(key)()
+
+    def load_all(self):
+        for key in list(self._loaders):
+            self._load(key)
+
+        return self
+
+    @property
+    def unloaded(self):
+        """The keys of the values that haven't been loaded"""
+        return list(self._loaders)
+
+    def __getitem__(self, key):
+        if key in self._loaders:
+            self._load(key)
+        return self._d[key]
+
+    def __setitem__(self, key, value):
+        self._loaders.pop(key, None)
+        self._d[key] = value
+
+    def __delitem__(self, key):
+        if self._loaders.pop(key, None) is not None and key not in self._d:
+            return
+        del self._d[key]
+
+    def __contains__(self, key):
+        return key in self._loaders or key in self._d
+
+    has_key = __contains__
+
+    def __iter__(self):
+        for key in self._d:
+            yield key
+        for key in list(self._loaders):
+            yield key
+
+    def __len__(self):
+        return len(self._d) + len(self._loaders)
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.copy())
@@ -14,9 +14,11 @@ import msgpack
 from six import iteritems, text_type
 from functools import reduce
 
-from gzipfile import GzipFile
-
 import base
+from compression import compress, get_codec, DEFAULT_CODEC
+from columnar import pack_columns, compress_columns
+from zonemaps import block_zone_map
+from collections import deque
 from os.path import exists
 
 MAX_CACHE = 10000
@@ -27,7 +29,34 @@ class RowpackWriter(object):
     FILE_HEADER_FORMAT = base.FILE_HEADER_FORMAT
     FILE_HEADER_FORMAT_SIZE = base.FILE_HEADER_FORMAT_SIZE
 
-    def __init__(self, path,  mode='wb', schema=None, meta=None):
+    def __init__(self, path,  mode='wb', schema=None, meta=None, workers=None, codec=None, level=None,
+                 layout='rows', zonemaps=True, stats=True, uniques=False, sketches=False, strict=True):
+        """
+
+        :param path: Path to the rowpack file
+        :param mode: File mode. 'wb' to create a new file, 'r+b' to update the metadata of an existing one,
+            or 'ab' to write rows after the rows of an existing file, or create it if it doesn't exist
+        :param schema: A Schema
+        :param meta: Dict of metadata
+        :param workers: If set, compress blocks in a pool of this many processes
+        :param codec: Name of the compression codec for new files. Defaults to 'gzip'. Use 'none' to store
+            blocks uncompressed, for files read with RowpackReader(..., mmap=True)
+        :param level: Compression level. Defaults to the codec's default level
+        :param layout: 'rows' to store blocks as arrays of rows, or 'columns' to store them as separately
+            compressed column chunks
+        :param zonemaps: If True, record the min, max and null count of each column in each block
+        :param stats: If True, and there is a schema, compute the count, nulls, min, max, mean and std of
+            each column as the rows are written, and store them in the schema columns when the file is closed
+        :param uniques: If True, also compute the number of uniques, median and most common values of each
+            column, which counts every distinct value unless sketches is True. Appends to a file that has
+            stored most common values always update them
+        :param sketches: If True, estimate the number of uniques, median and most common values of each
+            column with fixed size sketches, rather than counting every distinct value. Implies uniques
+        :param strict: If True, and there is a schema, values must be of types that can be stored without
+            converting them, or writing a block raises RowpackTypeError. If False, other values, such as
+            Decimals, are converted to strings, as they are without a schema. Pass strict=False to write
+            Decimals, or other values that aren't dates or times, to a file with a schema
+        """
 
         self.path = path
 
@@ -45,10 +74,43 @@ class RowpackWriter(object):
         self.data_end = 0
         self.meta_end = 0
 
+        # Index of the row blocks, each a tuple of (offset, length, first row, number of rows)
+        self.blocks = []
+
+        # Unused ranges of the file, each a tuple of (offset, length), which new blocks and metadata fill before
+        # they are written at the end of the used part of the file, at self._end
+        self.free = []
+        self._end = 0
+
+        self.codec = codec or DEFAULT_CODEC
+        self.level = level if level is not None else get_codec(self.codec).default_level
+        self.layout = layout
+
+        # Per block, per column, [min, max, null count], or None for blocks without zone maps
+        self.zonemaps = []
+        self.record_zonemaps = zonemaps
+
+        # Column name to an index of the column's values, a dict of value to a list of (block, offset).
+        # Indexes are updated as blocks are written
+        self.indexes = {}
+
+        # Per schema column ColumnStats, created with the first block written with a schema
+        self.record_stats = stats
+        self.uniques = uniques or sketches
+        self.sketches = sketches
+        self._stats = None
+
+        self.strict = strict
+
         self.writable = False
 
         self._fh = None
-        self._zfh = None
+
+        # Blocks that are being compressed in the pool, each a tuple of
+        # (async result, first row, number of rows), in file order
+        self.workers = workers
+        self._pool = None
+        self._pending = deque()
 
         self.open()
 
@@ -58,7 +120,7 @@ class RowpackWriter(object):
 
         if self._fh is None:
 
-            if self.mode.startswith('r+') and exists(self.path):
+            if (self.mode.startswith('r+') or self.mode.startswith('a')) and exists(self.path):
                 from reader import RowpackReader
                 with RowpackReader(self.path) as r:
                     self.data_start = r.data_start
@@ -66,47 +128,149 @@ class RowpackWriter(object):
                     self.meta_end = r.meta_end
                     self.n_rows = r.n_rows
                     self.n_cols = r.n_cols
+                    self.version = r.version
+                    self.blocks = r.blocks
+                    self.codec = r.codec
+                    self.level = r.level
+                    self.layout = r.layout
 
+                    # The metadata will be rewritten over the old metadata, so load all of it first
+                    r.load_metadata()
+
+                    self.zonemaps = r.zonemaps
+                    self.indexes = r.indexes
                     self.schema = r.schema
-                    self.meta = r.meta
+                    self.meta = dict(r.meta.items())
+
+                # An append keeps the old metadata until the header points to the new metadata
+                self._find_free(keep_meta=self.mode.startswith('a'))
 
-                self._fh = open(self.path, self.mode)
+                if self.mode.startswith('a'):
+                    self._open_append()
+                else:
+                    self._fh = open(self.path, self.mode)
 
             else:
-                self._fh = open(self.path, self.mode)
+                self._fh = open(self.path, 'wb' if self.mode.startswith('a') else self.mode)
                 self.write_file_header() # Writes mostly empty header. Will re-write later.
 
                 self.data_start = self._fh.tell()
                 self.data_end = self._fh.tell()
+                self._end = self._fh.tell()
 
                 self.writable = True
 
-                self._zfh = GzipFile(fileobj=self._fh, compresslevel=9)  # Compressor for writing rows
+                if self.workers:
+                    from multiprocessing import Pool
+                    self._pool = Pool(self.workers)
+
+    def _find_free(self, keep_meta):
+        """Find the free ranges of an existing file, which are the gaps between its blocks and, if keep_meta is
+        True, its metadata, such as the metadata replaced by earlier appends. Also find the end of the used part
+        of the file. """
+
+        if self.blocks:
+            used = [(offset, length) for offset, length, first_row, n_rows in self.blocks]
+        else:
+            used = [(self.data_start, self.data_end - self.data_start)]  # Files without a block index
+
+        if keep_meta:
+            used.append((self.data_end, self.meta_end - self.data_end))
+
+        self.free = []
+        self._end = self.data_start
+
+        for offset, length in sorted(used):
+            if offset > self._end:
+                self.free.append((self._end, offset - self._end))
+            self._end = max(self._end, offset + length)
+
+    def _allocate(self, length):
+        """Return the offset to write length bytes at, in the first free range that is large enough, or at the
+        end of the used part of the file"""
+
+        for i, (offset, free_length) in enumerate(self.free):
+            if free_length >= length:
+                if free_length == length:
+                    del self.free[i]
+                else:
+                    self.free[i] = (offset + length, free_length - length)
+                return offset
+
+        offset = self._end
+        self._end += length
+
+        return offset
+
+    def _open_append(self):
+        """Open an existing file to write more blocks. The new blocks, and the new metadata when the writer is
+        closed, are written in the free ranges of the file, or after the end of its used part, and the old
+        metadata is left in place until the header is written, so the cost is proportional to the number of new
+        rows, not the size of the file. Until the header is written, the file is still the old file, so an
+        append that is interrupted loses only the new rows.
+
+        The old metadata is then a free range, which the next append reuses, so repeated appends don't leave a
+        copy of the metadata behind each time. """
+        from colstats import ColumnStats
+        from math import isnan
+        from .exceptions import RowpackError
 
+        if self.n_rows and not self.blocks:
+            raise RowpackError("Can't append to a version {} file, which has no block index; path = {}"
+                               .format(self.version, self.path))
 
+        # Files written without a schema keep the encoding of values without one
+        if self.schema is not None and not self.schema.columns:
+            self.schema = None
 
-    def close_zfh(self):
+        # Blocks written before zone maps were recorded have none
+        self.zonemaps = list(self.zonemaps) + [None] * (len(self.blocks) - len(self.zonemaps))
 
-        if self._zfh is not None:
-            self._zfh.close()
-            self._zfh = None
+        # Update the stored statistics, if there are any for all of the columns
+        if self.record_stats and self.schema and not any(isnan(c.count) for c in self.schema):
+            # Keep the most common values up to date if the file has them, rather than dropping them
+            self.uniques = self.uniques or any(c.uvalues is not None for c in self.schema)
+            self._stats = [ColumnStats.from_column(c, self.sketches, self.uniques) for c in self.schema]
+        else:
+            self.record_stats = False
 
-            self.data_end = self._fh.tell() # Closing Gzip writes mroe data
+        # Append mode files ignore seeks for writes, so the file is opened for update
+        self._fh = open(self.path, 'r+b')
 
-    def close(self):
+        self.writable = True
 
-        if self._fh is not None:
+        if self.workers:
+            from multiprocessing import Pool
+            self._pool = Pool(self.workers)
 
-            self.flush()
+    def close(self):
 
-            self.close_zfh()
+        try:
+            if self._fh is not None:
+                try:
+                    self.flush()
 
-            self.write_meta() # Seeks to end of file
+                    self.write_meta() # Seeks to end of file
 
-            self.write_file_header() # Seeks to start of file
+                    if self.mode.startswith('a'):
+                        # Make sure the blocks and metadata are on disk before the header points to them
+                        self._fh.flush()
+                        os.fsync(self._fh.fileno())
 
-            self._fh.close()
-            self._fh = None
+                    self.write_file_header() # Seeks to start of file
+
+                    # Drop the old metadata, if it was at the end of the file, and the blocks of an
+                    # interrupted append
+                    self._fh.truncate(max([self.meta_end] +
+                                          [offset + length for offset, length, _, _ in self.blocks]))
+                finally:
+                    self._fh.close()
+                    self._fh = None
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
 
 
     def write_file_header(self):
@@ -121,7 +285,7 @@ class RowpackWriter(object):
 
         self._fh.seek(0)
 
-        hdf = self.FILE_HEADER_FORMAT.pack(magic, self.VERSION, self.n_rows,self.n_cols,
+        hdf = self.FILE_HEADER_FORMAT.pack(magic, self.version, self.n_rows,self.n_cols,
                                            self.data_start, self.data_end, self.meta_end)
 
         assert len(hdf) == self.FILE_HEADER_FORMAT_SIZE
@@ -131,17 +295,36 @@ class RowpackWriter(object):
         assert self._fh.tell() == self.FILE_HEADER_FORMAT_SIZE, (self._fh.tell(), self.FILE_HEADER_FORMAT_SIZE)
 
     def write_meta(self):
+        from util import pack_default, pack_index
 
         self.flush()
 
-        self._fh.seek(self.data_end)
+        if self._stats is not None:
+            for c, s in zip(self.schema.columns, self._stats):
+                s.update_column(c)
 
         d = {
-            'meta': self.meta if self.meta else {},
-            'schema': self.schema.to_rows() if self.schema else []
+            'meta': dict(self.meta.items()) if self.meta else {},
+            'schema': self.schema.to_rows() if self.schema else [],
+            'blocks': self.blocks,
+            'codec': {'name': self.codec, 'level': self.level},
+            'layout': self.layout
         }
 
-        b = msgpack.packb(d, encoding='utf-8')
+        if any(zm is not None for zm in self.zonemaps):
+            d['zonemaps'] = self.zonemaps
+
+        if self.indexes and self.version < base.SECTIONED_META_VERSION:
+            d['indexes'] = {name: pack_index(index) for name, index in self.indexes.items()}
+
+        if self.version >= base.SECTIONED_META_VERSION:
+            b = self._pack_sections(d)
+        else:
+            b = msgpack.packb(d, default=pack_default(self.version), encoding='utf-8')
+
+        self.data_end = self._allocate(len(b))
+
+        self._fh.seek(self.data_end)
 
         self._fh.write(b)
 
@@ -150,31 +333,246 @@ class RowpackWriter(object):
         self.writable = False
 
 
+    def _pack_sections(self, d):
+        """Pack the metadata dict as a section table and sections. The zone maps, the uvalues of the schema
+        columns, and any metadata value that is larger than LAZY_SECTION_SIZE each get their own section, and
+        the rest goes in the 'core' section, which readers always load.
+
+        Each column index is sorted by value and split into pages of INDEX_PAGE_SIZE values, each packed
+        separately, in an 'index_pages:' section. The 'index:' section has the first value, offset and length
+        of each page, so a lookup unpacks only one page. """
+        from util import pack_default, page_index, decode_ext
+
+        default = pack_default(self.version)
+
+        def pack(v):
+            return msgpack.packb(v, default=default, encoding='utf-8')
+
+        def repack(v):
+            return msgpack.unpackb(pack(v), encoding='utf-8', ext_hook=decode_ext)
+
+        sections = []
+
+        meta = d['meta']
+
+        for k in sorted(meta):
+            b = pack(meta[k])
+            if len(b) > base.LAZY_SECTION_SIZE:
+                sections.append(('meta:' + k, b))
+                del meta[k]
+
+        uvalues = [c.pop('uvalues', None) for c in d['schema']]
+
+        if any(uv is not None for uv in uvalues):
+            sections.append(('uvalues', pack(uvalues)))
+
+        if 'zonemaps' in d:
+            sections.append(('zonemaps', pack(d.pop('zonemaps'))))
+
+        for name, index in sorted(self.indexes.items()):
+            first_values, pages = page_index(index, base.INDEX_PAGE_SIZE, repack)
+            pages = [pack(page) for page in pages]
+
+            table = []
+            offset = 0
+            for v, page in zip(first_values, pages):
+                table.append((v, offset, len(page)))
+                offset += len(page)
+
+            sections.append(('index:' + name, pack(table)))
+            sections.append(('index_pages:' + name, b''.join(pages)))
+
+        sections.insert(0, ('core', pack(d)))
+
+        table = []
+        offset = 0
+        for name, b in sections:
+            table.append((name, offset, len(b)))
+            offset += len(b)
+
+        table = msgpack.packb(table, encoding='utf-8')
+
+        return base.SECTION_TABLE_FORMAT.pack(len(table)) + table + b''.join(b for name, b in sections)
+
     def write_row(self, row):
         """Store a single row in the cache, to be written later"""
         self.cache.append(row)
 
-        if len(self.cache) > MAX_CACHE:
-            self.flush()
+        if len(self.cache) >= MAX_CACHE:
+            self._flush_cache()
 
     def write_rows(self, rows):
-        """Write a block of rows"""
-        from util import encode_obj
+        """Write a set of rows, in blocks of no more than MAX_CACHE rows"""
         from .exceptions import RowpackError
 
         if not self.writable:
-            raise RowpackError("Can't write to existing file; can only update metadata" )
+            raise RowpackError("Can't write rows to a file opened to update metadata; "
+                               "open it with mode 'ab' to append rows")
+
+        for i in range(0, len(rows), MAX_CACHE):
+            self.write_block(rows[i:i + MAX_CACHE])
+
+    def write_block(self, rows):
+        """Compress a block of rows independently of other blocks and add it to the block index. With
+        a pool, the block is queued for compression, and written when it and all earlier blocks are done"""
+        from util import pack_default, encode_typed, EXT_TYPE_VERSION
+
+        # With a schema, values that msgpack can't pack natively must be dates or times
+        if self.schema and self.strict and self.version >= EXT_TYPE_VERSION:
+            default = encode_typed
+        else:
+            default = pack_default(self.version)
+
+        try:
+            if self.layout == 'columns':
+                data = pack_columns(rows, self.version, default)
+                compress_f = compress_columns
+            else:
+                data = msgpack.packb(rows, default=default, encoding='utf-8')
+                compress_f = compress
+        except TypeError as e:
+            if default is encode_typed:
+                self._raise_type_error(rows, e)
+            raise
+
+        self.zonemaps.append(block_zone_map(rows, default) if self.record_zonemaps else None)
+
+        if self.indexes:
+            self._add_index_values(rows, len(self.zonemaps) - 1)
+
+        if self.record_stats and self.schema:
+            self._add_stats(rows)
+
+        if self._pool is None:
+            self._write_compressed(compress_f(data, self.codec, self.level), self.n_rows, len(rows))
+        else:
+            result = self._pool.apply_async(compress_f, (data, self.codec, self.level))
+            self._pending.append((result, self.n_rows, len(rows)))
+
+            # Limit the number of packed blocks held in memory
+            while len(self._pending) > self.workers * 2:
+                self._write_pending()
 
         self.n_rows += len(rows)
 
-        self._zfh.write(msgpack.packb(rows, default=encode_obj, encoding='utf-8'))
+    def copy_block(self, data, n_rows, zonemap=None):
+        """Write a block that is already packed and compressed, such as a block read from another file with
+        RowpackReader.read_block_data. The block must have the writer's codec and layout, and be encoded for
+        the writer's version. The rows aren't added to the column statistics; use add_stats for them. """
+        from .exceptions import RowpackError
+
+        if not self.writable:
+            raise RowpackError("Can't write rows to a file opened to update metadata; "
+                               "open it with mode 'ab' to append rows")
+
+        self.flush()
+
+        if self.indexes:
+            raise RowpackError("Can't copy blocks to a file with indexes, which would need the values of the rows")
+
+        self.zonemaps.append(zonemap if self.record_zonemaps else None)
+
+        self._write_compressed(data, self.n_rows, n_rows)
+
+        self.n_rows += n_rows
+
+    def _add_index_values(self, rows, block):
+        from util import index_values
+
+        headers = self.schema.headers if self.schema else []
+
+        for name, index in self.indexes.items():
+            pos = headers.index(name)
+            index_values(index, [row[pos] if pos < len(row) else None for row in rows], block)
+
+    def add_stats(self, stats):
+        """Merge a list of ColumnStats, one per schema column, into the statistics of the rows written,
+        for rows written with copy_block"""
+        from colstats import ColumnStats
+
+        if not self.record_stats or not self.schema:
+            return
+
+        if self._stats is None:
+            self._stats = [ColumnStats(c.name, c.python_type, self.sketches, self.uniques)
+                           for c in self.schema.columns]
+
+        for s, other in zip(self._stats, stats):
+            s.merge(other)
+
+    def _add_stats(self, rows):
+        from colstats import ColumnStats
+        from util import rows_to_columns
+
+        columns = self.schema.columns
 
+        if self._stats is None:
+            self._stats = [ColumnStats(c.name, c.python_type, self.sketches, self.uniques) for c in columns]
+
+        for s, values in zip(self._stats, rows_to_columns(rows, len(columns))):
+            s.add_values(values)
+
+    def stats(self):
+        """Write any cached rows, and return an OrderedDict of the ColumnStats of each schema column for
+        the rows written so far. Empty if there is no schema or stats are disabled. """
+        from collections import OrderedDict
+
+        self.flush()
+
+        return OrderedDict((s.name, s) for s in self._stats or [])
+
+    def _raise_type_error(self, rows, e):
+        """Raise an error that lists all of the values in a block that can't be encoded with the schema"""
+        from util import untyped_values
+        from .exceptions import RowpackTypeError
+
+        MAX_LISTED = 10
+
+        untyped = untyped_values(rows, self.schema.headers, self.n_rows)
+
+        if not untyped:
+            raise RowpackTypeError("Failed to encode block starting at row {}: {}".format(self.n_rows, e))
+
+        listed = '; '.join("row {}, column '{}': {!r}".format(row_n, name, v)
+                           for row_n, name, v in untyped[:MAX_LISTED])
+
+        if len(untyped) > MAX_LISTED:
+            listed += '; and {} more'.format(len(untyped) - MAX_LISTED)
+
+        raise RowpackTypeError("{} values in the block starting at row {} are not of a type that can be stored "
+                               "with a schema. Convert them to the schema datatypes before writing. {}"
+                               .format(len(untyped), self.n_rows, listed))
+
+    def _write_pending(self):
+        """Wait for the oldest block in the compression pool, and write it"""
+        result, first_row, n_rows = self._pending.popleft()
+        self._write_compressed(result.get(), first_row, n_rows)
+
+    def _write_compressed(self, data, first_row, n_rows):
+
+        offset = self._allocate(len(data))
+
+        self._fh.seek(offset)
+        self._fh.write(data)
+
+        self.blocks.append((offset, len(data), first_row, n_rows))
+
+    def _flush_cache(self):
+        """Write the cached rows. The cache is emptied first, so rows that fail to be written, such as
+        with a RowpackTypeError, aren't written again by later writes or by close()"""
+
+        rows, self.cache = self.cache, []
+
+        if rows:
+            self.write_rows(rows)
 
     def flush(self):
+        """Write the cached rows, and wait for all blocks to be compressed and written"""
+
+        self._flush_cache()
 
-        if self.cache:
-            self.write_rows(self.cache)
-            self.cache = []
+        while self._pending:
+            self._write_pending()
 
 
     def __enter__(self):
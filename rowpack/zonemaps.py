@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE.txt
+
+"""
+
+Zone maps: the minimum, maximum and null count of each column in each block. Readers use them to
+skip blocks that can't have rows that match a predicate.
+
+"""
+
+import operator
+from six import string_types
+
+from util import rows_to_columns, decode_obj, index_stable_types
+
+# Strings longer than this aren't stored in zone maps, to keep the metadata small.
+MAX_ZONE_STRING = 100
+
+
+def _in(v, values):
+    return v in values
+
+ops = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': _in
+}
+
+
+def _stored_values(values, default):
+    """Return the values as they are read back after they are packed with the msgpack default function, such
+    as Decimals as strings, or None if some can't be, such as lists. NaNs and nulls are dropped. """
+
+    if default is not None and not set(map(type, values)) <= index_stable_types:
+        values = [v if type(v) in index_stable_types else default(v) for v in values]
+
+        if not set(map(type, values)) <= index_stable_types | {type(None)}:
+            return None
+
+    return [v for v in values if v is not None and v == v]
+
+
+def block_zone_map(rows, default=None):
+    """Return a list, one entry per column, of the [min, max, null count] of the column in a
+    block of rows. The min and max are of the values as they are stored, with the msgpack default
+    function, and are None if they can't be computed or stored. NaNs aren't included. """
+
+    zm = []
+
+    for column in rows_to_columns(rows):
+        values = [v for v in column if v is not None]
+        nulls = len(column) - len(values)
+
+        try:
+            values = _stored_values(values, default)
+            mn, mx = (min(values), max(values)) if values else (None, None)
+        except (TypeError, ValueError):  # Including UnicodeDecodeError, comparing str and unicode
+            mn, mx = None, None
+
+        if (isinstance(mn, string_types) and len(mn) > MAX_ZONE_STRING) or \
+                (isinstance(mx, string_types) and len(mx) > MAX_ZONE_STRING):
+            mn, mx = None, None
+
+        zm.append([mn, mx, nulls])
+
+    return zm
+
+
+def decode_zone_maps(zonemaps):
+    """Convert the dates and times in zone maps read from the metadata of version 4 files, which are encoded
+    as dicts, back to Python objects"""
+
+    def dec(v):
+        return decode_obj(v) if isinstance(v, dict) else v
+
+    return [[(dec(mn), dec(mx), nulls) for mn, mx, nulls in zm] if zm is not None else None for zm in zonemaps]
+
+
+def zone_may_match(zone, n_rows, op, value):
+    """Return False if no value in the range of the zone, a (min, max, null count) tuple for
+    a block of n_rows rows, can match the predicate. Nulls never match. """
+
+    if zone is None:
+        return False  # The column is past the end of every row in the block, so it is all nulls
+
+    mn, mx, nulls = zone
+
+    if nulls >= n_rows:
+        return False
+
+    if mn is None or mx is None:
+        return True  # The range wasn't recorded
+
+    try:
+        if op in ('=', '=='):
+            return mn <= value <= mx
+        elif op == '!=':
+            return not (mn == mx == value)
+        elif op == '<':
+            return mn < value
+        elif op == '<=':
+            return mn <= value
+        elif op == '>':
+            return mx > value
+        elif op == '>=':
+            return mx >= value
+        elif op == 'in':
+            return any(mn <= v <= mx for v in value)
+    except TypeError:
+        pass
+
+    return True
+
+
+
+def filter_rows(rows, where):
+    """Return a tuple of the rows that match all of the predicates in where, a list of
+    (position, op, value) tuples. Null or missing values never match. """
+
+    for pos, op, value in where:
+        f = ops[op]
+        rows = tuple(row for row in rows if pos < len(row) and row[pos] is not None and f(row[pos], value))
+
+    return rows
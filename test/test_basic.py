@@ -3,6 +3,39 @@ import unittest
 from rowpack import RowpackReader, RowpackWriter, Schema
 
 
+class stub_rowgenerators(object):
+    """Replace the rowgenerators module with one with a SourceSpec that generates the rows returned by
+    make_rows(encoding), for testing ingest without downloading anything"""
+
+    def __init__(self, make_rows):
+        import types
+
+        class SourceSpec(object):
+            def __init__(self, url, encoding=None, filetype=None, urlfiletype=None):
+                self.url = url
+                self.encoding = encoding
+                self.file_name = '/tmp/ingested'
+                self.dict = dict(url=url, encoding=encoding)
+
+            def get_generator(self, cache):
+                return make_rows(self.encoding)
+
+        self.module = types.ModuleType('rowgenerators')
+        self.module.SourceSpec = SourceSpec
+
+    def __enter__(self):
+        import sys
+        self.saved = sys.modules.get('rowgenerators')
+        sys.modules['rowgenerators'] = self.module
+
+    def __exit__(self, *args):
+        import sys
+        if self.saved is None:
+            del sys.modules['rowgenerators']
+        else:
+            sys.modules['rowgenerators'] = self.saved
+
+
 class TestBasic(unittest.TestCase):
 
     def test_basic(self):
@@ -24,8 +57,8 @@ class TestBasic(unittest.TestCase):
 
         with RowpackReader('/tmp/foo.rp') as rpr:
             self.assertEquals(42, rpr.data_start)
-            self.assertEquals(83, rpr.data_end)
-            self.assertEquals(1676, rpr.meta_end)
+            self.assertEquals(76, rpr.data_end)
+            self.assertEquals(2033, rpr.meta_end)
             self.assertEquals({u'foo': u'bar'}, rpr.meta)
             self.assertEquals(
                 [u'col0', u'col1', u'col2', u'col3', u'col4', u'col5', u'col6', u'col7', u'col8', u'col9'],
@@ -45,6 +78,1083 @@ class TestBasic(unittest.TestCase):
                 [u'col0', u'col1', u'col2', u'col3', u'col4', u'col5', u'col6', u'col7', u'col8', u'col9'],
                 rpr.headers)
 
+    def test_block_index(self):
+        from rowpack.writer import MAX_CACHE
+
+        N = 3 * MAX_CACHE + 500
+
+        with RowpackWriter('/tmp/foo.rp', 'wb') as rpw:
+            for i in range(N):
+                rpw.write_row((i, i * 2, str(i)))
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            self.assertEqual(N, rpr.n_rows)
+            self.assertEqual(4, len(rpr.blocks))
+            self.assertEqual(0, rpr.blocks[0][2])
+            self.assertEqual(N, sum(b[3] for b in rpr.blocks))
+
+            self.assertEqual((0, 0, '0'), rpr[0])
+            self.assertEqual((N - 1, (N - 1) * 2, str(N - 1)), rpr[-1])
+            self.assertEqual((20000, 40000, '20000'), rpr[20000])
+
+            self.assertEqual(list(range(MAX_CACHE - 5, MAX_CACHE + 5)),
+                             [row[0] for row in rpr.rows(MAX_CACHE - 5, MAX_CACHE + 5)])
+            self.assertEqual([N - 3, N - 2, N - 1], [row[0] for row in rpr[-3:]])
+            self.assertEqual([10, 20, 30], [row[0] for row in rpr[10:40:10]])
+            self.assertEqual(list(range(N)), [row[0] for row in rpr])
+
+            with self.assertRaises(IndexError):
+                rpr[N]
+
+        with RowpackWriter('/tmp/foo.rp', 'r+b') as rpw:
+            rpw.meta['bingo'] = 'baz'
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            self.assertEqual(4, len(rpr.blocks))
+            self.assertEqual((30000, 60000, '30000'), rpr[30000])
+
+    def test_parallel_read(self):
+        from rowpack.writer import MAX_CACHE
+
+        N = 5 * MAX_CACHE + 10
+
+        with RowpackWriter('/tmp/foo.rp', 'wb') as rpw:
+            for i in range(N):
+                rpw.write_row((i, str(i)))
+
+        with RowpackReader('/tmp/foo.rp', workers=2) as rpr:
+            self.assertEqual(list(range(N)), [row[0] for row in rpr])
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            blocks = list(rpr.iter_blocks(parallel=True))
+
+            self.assertEqual(6, len(blocks))
+            self.assertEqual(list(range(N)), sorted(row[0] for rows in blocks for row in rows))
+
+    def test_parallel_write(self):
+        from rowpack.writer import MAX_CACHE
+
+        N = 7 * MAX_CACHE + 10
+
+        for path, workers in (('/tmp/foo.rp', None), ('/tmp/foo_par.rp', 3)):
+            with RowpackWriter(path, 'wb', workers=workers) as rpw:
+                for i in range(N):
+                    rpw.write_row((i, str(i)))
+
+        with RowpackReader('/tmp/foo_par.rp') as rpr:
+            self.assertEqual(N, rpr.n_rows)
+            self.assertEqual(8, len(rpr.blocks))
+            self.assertEqual(list(range(N)), [row[0] for row in rpr])
+
+        with open('/tmp/foo.rp', 'rb') as f1, open('/tmp/foo_par.rp', 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_codecs(self):
+        from rowpack.compression import codecs
+        from rowpack import RowpackError
+
+        N = 25000
+
+        for name in codecs:
+            with RowpackWriter('/tmp/foo.rp', 'wb', codec=name) as rpw:
+                for i in range(N):
+                    rpw.write_row((i, str(i)))
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertEqual(name, rpr.codec)
+                self.assertEqual(list(range(N)), [row[0] for row in rpr])
+                self.assertEqual((20000, '20000'), rpr[20000])
+
+        with RowpackWriter('/tmp/foo.rp', 'wb', codec='gzip', level=1) as rpw:
+            rpw.write_rows([(i, str(i)) for i in range(N)])
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            self.assertEqual(('gzip', 1), (rpr.codec, rpr.level))
+
+        # Levels outside of the range of bz2 are clamped to it
+        for level in (0, 12):
+            with RowpackWriter('/tmp/foo.rp', 'wb', codec='bz2', level=level) as rpw:
+                rpw.write_rows([(i, str(i)) for i in range(N)])
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertEqual((20000, '20000'), rpr[20000])
+
+        with self.assertRaises(RowpackError):
+            RowpackWriter('/tmp/foo.rp', 'wb', codec='nope')
+
+    def test_ext_types(self):
+        import datetime
+        import msgpack
+        from rowpack.util import encode_ext, decode_ext
+
+        class V4Writer(RowpackWriter):
+            VERSION = 4
+
+        values = [datetime.datetime(2016, 2, 29, 23, 59, 58, 123456), datetime.datetime(1901, 7, 4, 1, 2, 3),
+                  datetime.date(2016, 2, 29), datetime.date(1812, 6, 1),
+                  datetime.time(13, 14, 15, 16), datetime.time(0, 0), None]
+
+        b = msgpack.packb(values, default=encode_ext)
+        self.assertEqual(values, msgpack.unpackb(b, ext_hook=decode_ext))
+
+        N = 25000
+
+        rows = [(i, datetime.datetime(1960, 1, 1, 0, 0, 0, 250000) + datetime.timedelta(hours=i),
+                 datetime.date(1812, 6, 1) + datetime.timedelta(days=i), datetime.time(i % 24, i % 60, 1, i))
+                for i in range(N)]
+
+        for writer_class, version in ((RowpackWriter, RowpackWriter.VERSION), (V4Writer, 4)):
+            for layout in ('rows', 'columns'):
+                with writer_class('/tmp/foo.rp', 'wb', layout=layout) as rpw:
+                    rpw.write_rows(rows)
+
+                with RowpackReader('/tmp/foo.rp') as rpr:
+                    self.assertEqual(version, rpr.version)
+                    self.assertEqual(datetime.date(1812, 6, 1), rpr.zonemaps[0][2][0])
+
+                    matched = list(rpr.filter(2, '<', datetime.date(1812, 6, 11)))
+                    self.assertEqual(list(range(10)), [r[0] for r in matched])
+
+                    if version >= 5:
+                        self.assertEqual(rows, list(rpr))
+                    else:
+                        # Version 4 files don't store microseconds
+                        self.assertEqual([(i, dt.replace(microsecond=0), d, t.replace(microsecond=0))
+                                          for i, dt, d, t in rows], list(rpr))
+
+    def test_typed_encoding(self):
+        import datetime
+        from decimal import Decimal
+        from rowpack import RowpackTypeError
+
+        s = Schema()
+        s.add_column(name='id', datatype='int')
+        s.add_column(name='date', datatype='date')
+        s.add_column(name='amount', datatype='float')
+
+        rows = [(i, datetime.date(2000, 1, 1) + datetime.timedelta(days=i), i * 1.5) for i in range(100)]
+
+        for layout in ('rows', 'columns'):
+            with RowpackWriter('/tmp/foo.rp', 'wb', schema=s, layout=layout) as rpw:
+                rpw.write_rows([('id', 'date', 'amount')] + rows)
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertEqual([('id', 'date', 'amount')] + rows, list(rpr))
+
+            bad_rows = [(i, d, Decimal(a) if i % 10 == 0 else a) for i, d, a in rows]
+
+            with RowpackWriter('/tmp/foo.rp', 'wb', schema=s, layout=layout) as rpw:
+                rpw.write_rows(rows)
+
+                with self.assertRaises(RowpackTypeError) as cm:
+                    rpw.write_rows(bad_rows)
+
+                self.assertIn('10 values', str(cm.exception))
+                self.assertIn("row 110, column 'amount': Decimal('15')", str(cm.exception))
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertEqual(rows, list(rpr))
+
+            # Cached rows that fail are dropped, and close() still closes the file
+            rpw = RowpackWriter('/tmp/foo.rp', 'wb', schema=s, layout=layout)
+            rpw.write_row(bad_rows[0])
+
+            with self.assertRaises(RowpackTypeError):
+                rpw.close()
+
+            self.assertEqual([], rpw.cache)
+            self.assertIsNone(rpw._fh)
+
+        # Without a schema, or with strict=False, unknown types are still converted to strings
+        for kwargs in ({}, {'schema': s, 'strict': False}):
+            with RowpackWriter('/tmp/foo.rp', 'wb', **kwargs) as rpw:
+                rpw.write_rows(bad_rows)
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertEqual('15', rpr[10][2])
+
+    def test_lazy_meta(self):
+        from rowpack.util import LazyDict
+
+        class V5Writer(RowpackWriter):
+            VERSION = 5
+
+        s = Schema()
+        s.add_column(name='id', datatype='int')
+        s.add_column(name='name', datatype='text')
+
+        N = 25000
+        rows = [(i, u'n' + str(i % 50)) for i in range(N)]
+        types = [[u'c{}'.format(i), i, i * 2, u'int'] for i in range(500)]
+
+        for writer_class in (RowpackWriter, V5Writer):
+            with writer_class('/tmp/foo.rp', 'wb', schema=s, uniques=True) as rpw:
+                rpw.meta['types'] = types
+                rpw.meta['url'] = u'http://example.com'
+                rpw.write_rows(rows)
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                if writer_class is RowpackWriter:
+                    self.assertIsInstance(rpr.meta, LazyDict)
+                    self.assertEqual(['types'], rpr.meta.unloaded)
+                    self.assertIsNotNone(rpr.schema[1]._uvalues_loader)
+                    self.assertIsNone(rpr._zonemaps)
+
+                # Displaying the schema doesn't load the uvalues
+                str(rpr.schema)
+
+                if writer_class is RowpackWriter:
+                    self.assertNotIn('uvalues', rpr.schema[1].dict)
+                    self.assertIsNotNone(rpr.schema[1]._uvalues_loader)
+
+                self.assertIn('types', rpr.meta)
+                self.assertEqual(['types', 'url'], sorted(rpr.meta.keys()))
+
+            # Copies include the sections that haven't been loaded
+            for copy in (dict, lambda m: dict(**m), lambda m: dict({}, **m), lambda m: m.copy()):
+                with RowpackReader('/tmp/foo.rp') as rpr:
+                    d = copy(rpr.meta)
+                    self.assertEqual({'types': types, 'url': u'http://example.com'}, d)
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                d = {}
+                d.update(rpr.meta)
+                self.assertEqual(types, d['types'])
+                self.assertEqual({'types': types, 'url': u'http://example.com'}, rpr.meta)
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertEqual(u'http://example.com', rpr.meta['url'])
+                self.assertEqual(list(range(N - 10, N)), [r[0] for r in rpr.filter('id', '>=', N - 10)])
+
+            # Sections can be loaded after the reader is closed
+            self.assertEqual(500, rpr.schema[1].uvalues[u'n0'])
+            self.assertEqual(types, rpr.meta['types'])
+
+            # Updating the metadata keeps the sections
+            with RowpackWriter('/tmp/foo.rp', 'r+b') as rpw:
+                rpw.meta['rowspec'] = {'start': 1}
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertEqual(types, rpr.meta['types'])
+                self.assertEqual({'start': 1}, rpr.meta['rowspec'])
+                self.assertEqual(500, rpr.schema[1].uvalues[u'n0'])
+                self.assertEqual(N, rpr.schema[0].count)
+                self.assertEqual(0, rpr.zonemaps[0][0][0])
+                self.assertEqual(rows, list(rpr))
+
+    def test_append(self):
+        import os
+        from math import isnan
+
+        s = Schema()
+        s.add_column(name='id', datatype='int')
+        s.add_column(name='x', datatype='float')
+        s.add_column(name='name', datatype='text')
+
+        def make_rows(start, stop):
+            return [(i, i * 1.5 if i % 7 else None, u'n' + str(i % 50)) for i in range(start, stop)]
+
+        rows = make_rows(0, 25000)
+        new_rows = make_rows(25000, 40000)
+
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s, uniques=True) as rpw:
+            rpw.meta['url'] = u'http://example.com'
+            rpw.write_rows(rows)
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            n_blocks = len(rpr.blocks)
+
+        with RowpackWriter('/tmp/foo.rp', 'ab', uniques=True) as rpw:
+            for row in new_rows:
+                rpw.write_row(row)
+
+        with RowpackWriter('/tmp/bar.rp', 'wb', schema=s, uniques=True) as rpw:
+            rpw.write_rows(rows + new_rows)
+
+        with RowpackReader('/tmp/foo.rp') as rpr, RowpackReader('/tmp/bar.rp') as rpr2:
+            self.assertEqual(40000, rpr.n_rows)
+            self.assertEqual(n_blocks + 2, len(rpr.blocks))
+            self.assertEqual(rows + new_rows, list(rpr))
+            self.assertEqual(u'http://example.com', rpr.meta['url'])
+            self.assertEqual(len(rpr.blocks), len(rpr.zonemaps))
+            self.assertEqual(list(range(39990, 40000)), [r[0] for r in rpr.filter('id', '>=', 39990)])
+
+            for c, c2 in zip(rpr.schema, rpr2.schema):
+                for k in ('count', 'nulls', 'min', 'max', 'mean', 'std'):
+                    if isnan(getattr(c2, k)):
+                        self.assertTrue(isnan(getattr(c, k)), (c.name, k))
+                    else:
+                        self.assertAlmostEqual(getattr(c2, k), getattr(c, k), places=6, msg=(c.name, k))
+
+                # Can't be updated from the stored statistics
+                self.assertTrue(isnan(c.nuniques))
+                self.assertTrue(isnan(c.median))
+
+            self.assertEqual(rpr2.schema[2].uvalues, rpr.schema[2].uvalues)
+            n0 = rpr.schema[2].uvalues[u'n0']
+
+        # Appending without uniques keeps the stored most common values up to date
+        with RowpackWriter('/tmp/foo.rp', 'ab') as rpw:
+            rpw.write_row((40000, 1.5, u'n0'))
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            self.assertEqual(n0 + 1, rpr.schema[2].uvalues[u'n0'])
+
+        # Appending to a file that doesn't exist creates it
+        if os.path.exists('/tmp/baz.rp'):
+            os.remove('/tmp/baz.rp')
+
+        with RowpackWriter('/tmp/baz.rp', 'ab', schema=s) as rpw:
+            rpw.write_rows(rows)
+
+        with RowpackWriter('/tmp/baz.rp', 'ab', schema=s) as rpw:
+            rpw.write_rows(new_rows)
+
+        with RowpackReader('/tmp/baz.rp') as rpr:
+            self.assertEqual(rows + new_rows, list(rpr))
+
+        # An append that is interrupted before the writer is closed leaves the original file
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+            rpw.write_rows(rows)
+
+        rpw = RowpackWriter('/tmp/foo.rp', 'ab')
+        rpw.write_rows(new_rows)
+        self.assertEqual(2, len(rpw.blocks) - n_blocks)
+
+        rpw._fh.close()  # As if the process was killed
+        rpw._fh = None
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            self.assertEqual(rows, list(rpr))
+            self.assertEqual(25000, rpr.schema[0].count)
+
+        # The next append writes over the blocks of the interrupted one
+        with RowpackWriter('/tmp/foo.rp', 'ab') as rpw:
+            rpw.write_rows(new_rows)
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            self.assertEqual(rows + new_rows, list(rpr))
+            self.assertEqual(40000, rpr.schema[0].count)
+
+        # Each append reuses the space of the metadata replaced by an earlier one, so small appends to a file
+        # with large metadata don't grow it by the size of the metadata each time
+        from rowpack import build_index
+
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+            rpw.write_rows(rows)
+
+        build_index('/tmp/foo.rp', 'name')
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            meta_size = rpr.meta_end - rpr.data_end
+
+        size = os.path.getsize('/tmp/foo.rp')
+        small_rows = []
+
+        for i in range(10):
+            small_rows += make_rows(25000 + i * 10, 25000 + (i + 1) * 10)
+
+            with RowpackWriter('/tmp/foo.rp', 'ab') as rpw:
+                rpw.write_rows(small_rows[-10:])
+
+            self.assertLess(os.path.getsize('/tmp/foo.rp'), size + 4 * meta_size)
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            self.assertEqual(rows + small_rows, list(rpr))
+            self.assertEqual(25100, rpr.schema[0].count)
+            self.assertEqual(502, len(rpr.lookup('name', u'n0')))
+
+        # Metadata in a free range before the new blocks can be updated
+        for i in range(3):
+            with RowpackWriter('/tmp/foo.rp', 'r+b') as rpw:
+                rpw.meta['note'] = u'x' * (i * 5000)
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertEqual(rows + small_rows, list(rpr))
+                self.assertEqual(i * 5000, len(rpr.meta['note']))
+
+    def test_append_header_rows(self):
+        from rowpack.stats import run_stats
+
+        s = Schema()
+        s.add_column(name='id', datatype='int')
+
+        # The header rows are counted in the column, but not in the mean and std
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+            rpw.write_rows([(u'id',), (u'identifier',)] + [(i,) for i in range(10)])
+
+        with RowpackWriter('/tmp/foo.rp', 'ab') as rpw:
+            rpw.write_rows([(i,) for i in range(10, 20)])
+
+        stats = run_stats('/tmp/foo.rp', update=False)
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            c = rpr.schema[0]
+            self.assertEqual(22, c.count)
+            self.assertEqual(20, c.numerics)
+            self.assertAlmostEqual(9.5, c.mean)
+            self.assertAlmostEqual(stats['id'].mean, c.mean)
+            self.assertAlmostEqual(stats['id'].stddev, c.std)
+
+    def test_concat(self):
+        from math import isnan
+        from rowpack import concat_files, RowpackError
+        from rowpack.cli import rowpack
+        from rowpack.stats import run_stats
+
+        s = Schema()
+        s.add_column(name='id', datatype='int')
+        s.add_column(name='x', datatype='float')
+        s.add_column(name='name', datatype='text')
+
+        def make_rows(start, stop):
+            return [(u'id', u'x', u'name')] + \
+                   [(i, i * 1.5 if i % 7 else None, u'n' + str(i % 50)) for i in range(start, stop)]
+
+        parts = [make_rows(0, 25000), make_rows(25000, 40000), make_rows(40000, 45000)]
+
+        for i, (rows, codec) in enumerate(zip(parts, ('gzip', 'gzip', 'zlib'))):
+            with RowpackWriter('/tmp/part{}.rp'.format(i), 'wb', schema=s, codec=codec, uniques=True) as rpw:
+                rpw.meta['rowspec'] = {'start': 1, 'end': len(rows) - 1, 'headers': [0]}
+                rpw.write_rows(rows)
+
+        paths = ['/tmp/part{}.rp'.format(i) for i in range(3)]
+
+        all_rows = parts[0] + parts[1][1:] + parts[2][1:]
+
+        self.assertEqual(len(all_rows), concat_files('/tmp/foo.rp', paths, uniques=True))
+
+        with RowpackWriter('/tmp/bar.rp', 'wb', schema=s, uniques=True) as rpw:
+            rpw.write_rows(all_rows)
+
+        stats = run_stats('/tmp/foo.rp', update=False)
+
+        with RowpackReader('/tmp/foo.rp') as rpr, RowpackReader('/tmp/bar.rp') as rpr2, \
+                RowpackReader(paths[1]) as rpr3:
+
+            self.assertEqual(all_rows, list(rpr))
+            self.assertEqual({'start': 1, 'end': len(all_rows) - 1, 'headers': [0]}, rpr.meta['rowspec'])
+            self.assertEqual(len(rpr.blocks), len(rpr.zonemaps))
+            self.assertEqual(list(range(5)), [r[0] for r in rpr.filter('id', '<', 5)])
+
+            # The full blocks of the second file are copied without recompressing them
+            self.assertEqual(rpr3.read_block_data(1), rpr.read_block_data(4))
+
+            for c, c2 in zip(rpr.schema, rpr2.schema):
+                self.assertEqual(c2.count, c.count)
+                self.assertEqual(c2.nulls, c.nulls)
+
+                # The header rows of each file are counted, but are not numeric
+                if isnan(c2.mean):
+                    self.assertTrue(isnan(c.mean), c.name)
+                    self.assertTrue(isnan(c.std), c.name)
+                else:
+                    self.assertEqual(c2.numerics, c.numerics)
+                    self.assertAlmostEqual(stats[c.name].mean, c.mean, places=6, msg=c.name)
+                    self.assertAlmostEqual(stats[c.name].stddev, c.std, places=6, msg=c.name)
+                    self.assertAlmostEqual(c2.mean, c.mean, places=6, msg=c.name)
+                    self.assertAlmostEqual(c2.std, c.std, places=6, msg=c.name)
+
+                self.assertTrue(isnan(c.nuniques))
+
+            self.assertEqual(rpr2.schema[2].uvalues, rpr.schema[2].uvalues)
+
+        rowpack(['concat', '--raw', '/tmp/foo.rp', paths[1], paths[2]])
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            self.assertEqual(parts[1] + parts[2], list(rpr))
+
+        s2 = Schema()
+        s2.add_column(name='id', datatype='int')
+
+        with RowpackWriter('/tmp/baz.rp', 'wb', schema=s2) as rpw:
+            rpw.write_rows([(1,)])
+
+        with self.assertRaises(RowpackError):
+            concat_files('/tmp/foo.rp', [paths[0], '/tmp/baz.rp'])
+
+    def test_split(self):
+        from rowpack import split_file, concat_files
+        from rowpack.cli import rowpack
+
+        s = Schema()
+        s.add_column(name='id', datatype='int')
+        s.add_column(name='name', datatype='text')
+
+        rows = [(u'id', u'name')] + [(i, u'n' + str(i % 50)) for i in range(45000)] + [(u'Footer',)]
+
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+            rpw.meta['rowspec'] = {'start': 1, 'end': 45000, 'headers': [0]}
+            rpw.write_rows(rows)
+
+        paths = split_file('/tmp/foo.rp', parts=2, uniques=True)
+
+        self.assertEqual(['/tmp/foo.0.rp', '/tmp/foo.1.rp'], paths)
+
+        with RowpackReader('/tmp/foo.rp') as rpr, RowpackReader(paths[0]) as rpr0, RowpackReader(paths[1]) as rpr1:
+            # Split at the nearest block boundary, so only the first block, with the header, is written again
+            self.assertEqual(rows[:1] + rows[1:20000], list(rpr0))
+            self.assertEqual(rows[:1] + rows[20000:], list(rpr1))
+            self.assertEqual(rpr.read_block_data(1), rpr0.read_block_data(2))
+            self.assertEqual(rpr.read_block_data(2), rpr1.read_block_data(1))
+
+            self.assertEqual({'start': 1, 'end': 19999, 'headers': [0]}, rpr0.meta['rowspec'])
+            self.assertEqual({'start': 1, 'end': 25001, 'headers': [0]}, rpr1.meta['rowspec'])
+
+            self.assertEqual(20000, rpr0.schema[0].count)
+            self.assertEqual(25003, rpr1.schema[0].count)
+            self.assertEqual(19998, rpr0.schema[0].max)
+            self.assertEqual(51, rpr1.schema[1].nuniques)  # With the header
+
+        paths = split_file('/tmp/foo.rp', rows_per_file=15000, out_pattern='/tmp/part{}.rp')
+
+        self.assertEqual(3, len(paths))
+
+        with RowpackReader(paths[1]) as rpr:
+            self.assertEqual(rows[:1] + rows[15001:30001], list(rpr))
+
+        concat_files('/tmp/bar.rp', paths)
+
+        # Concatenating keeps only the data rows of the files after the first, so the footer is dropped
+        with RowpackReader('/tmp/bar.rp') as rpr:
+            self.assertEqual(rows[:-1], list(rpr))
+            self.assertEqual({'start': 1, 'end': 45000, 'headers': [0]}, rpr.meta['rowspec'])
+
+        rowpack(['split', '-n', '3', '-o', '/tmp/part{}.rp', '/tmp/foo.rp'])
+
+        with RowpackReader('/tmp/part2.rp') as rpr:
+            self.assertEqual(rows[:1] + rows[30000:], list(rpr))
+
+        # There are no more files than data rows
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+            rpw.meta['rowspec'] = {'start': 1, 'headers': [0]}
+            rpw.write_rows(rows[:4])
+
+        paths = split_file('/tmp/foo.rp', parts=5, out_pattern='/tmp/part{}.rp')
+
+        self.assertEqual(3, len(paths))
+
+        for i, p in enumerate(paths):
+            with RowpackReader(p) as rpr:
+                self.assertEqual(rows[:1] + rows[i + 1:i + 2], list(rpr))
+
+        # A file with no data rows is split into one file with just the header rows and metadata
+        for empty_rows in ([], rows[:1]):
+            with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+                rpw.meta['rowspec'] = {'start': len(empty_rows), 'headers': [0] if empty_rows else []}
+                rpw.write_rows(empty_rows)
+
+            for kwargs in ({'parts': 2}, {'rows_per_file': 100}):
+                paths = split_file('/tmp/foo.rp', out_pattern='/tmp/part{}.rp', **kwargs)
+
+                self.assertEqual(1, len(paths))
+
+                for p in paths:
+                    with RowpackReader(p) as rpr:
+                        self.assertEqual(empty_rows, list(rpr))
+                        self.assertEqual(['id', 'name'], rpr.schema.headers)
+                        self.assertEqual(len(empty_rows), rpr.meta['rowspec']['start'])
+
+    def test_sort(self):
+        import random
+        from rowpack import sort_file
+        from rowpack.cli import rowpack
+
+        s = Schema()
+        s.add_column(name='id', datatype='int')
+        s.add_column(name='group', datatype='int')
+
+        rand = random.Random(1)
+        data = [(i, rand.choice([1, 2, 3, None])) for i in rand.sample(range(25000), 25000)]
+        rows = [(u'id', u'group')] + data + [(u'Footer',)]
+
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s, uniques=True) as rpw:
+            rpw.meta['rowspec'] = {'start': 1, 'end': 25000, 'headers': [0]}
+            rpw.write_rows(rows)
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            stats = [c.dict for c in rpr.schema]
+
+        by_group = sorted(data, key=lambda row: (row[1] is None, row[1], row[0]))
+
+        for kwargs in ({}, {'run_rows': 7000}, {'run_rows': 7000, 'workers': 2}):
+            sort_file('/tmp/foo.rp', '/tmp/bar.rp', ['group', 'id'], **kwargs)
+
+            with RowpackReader('/tmp/bar.rp') as rpr:
+                self.assertEqual(rows[:1] + by_group + rows[-1:], list(rpr))
+                self.assertEqual({'start': 1, 'end': 25000, 'headers': [0]}, rpr.meta['rowspec'])
+                self.assertEqual(stats, [c.dict for c in rpr.schema])
+
+        rowpack(['sort', '--by', 'id', '--run-rows', '10000', '/tmp/foo.rp', '/tmp/bar.rp'])
+
+        with RowpackReader('/tmp/bar.rp') as rpr:
+            self.assertEqual(rows[:1] + sorted(data) + rows[-1:], list(rpr))
+
+            # After sorting, the zone maps skip all but the first block
+            self.assertEqual([True, False, False], [rpr.block_may_match(n, [(0, '<', 100)])
+                                                    for n in range(len(rpr.blocks))])
+
+    def test_index(self):
+        import datetime
+        import sys
+        from six import StringIO
+        from rowpack import build_index
+        from rowpack.cli import rowpack
+
+        class V4Writer(RowpackWriter):
+            VERSION = 4
+
+        s = Schema()
+        s.add_column(name='geoid', datatype='text')
+        s.add_column(name='n', datatype='int')
+        s.add_column(name='date', datatype='date')
+
+        d = datetime.date(2016, 1, 1)
+
+        rows = [(u'g{}'.format(i), i, d + datetime.timedelta(days=i % 10)) for i in range(45000)]
+
+        for writer_class in (RowpackWriter, V4Writer):
+            with writer_class('/tmp/foo.rp', 'wb', schema=s) as rpw:
+                rpw.write_rows(rows)
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertIsNone(rpr.index('geoid'))
+                self.assertEqual([rows[1234]], rpr.lookup('geoid', u'g1234'))
+
+            self.assertEqual([(3, 4567)], build_index('/tmp/foo.rp', 'geoid')[u'g34567'])
+
+            rowpack(['index', '-c', 'date', '/tmp/foo.rp'])
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                read_blocks = []
+                read_block = rpr.read_block
+
+                def counting_read_block(n):
+                    read_blocks.append(n)
+                    return read_block(n)
+
+                rpr.read_block = counting_read_block
+
+                read_sections = []
+                read_section = rpr.read_section
+
+                def counting_read_section(name, *args):
+                    read_sections.append(name)
+                    return read_section(name, *args)
+
+                rpr.read_section = counting_read_section
+
+                self.assertEqual([rows[34567]], rpr.lookup('geoid', u'g34567'))
+                self.assertEqual([3], read_blocks)
+
+                if writer_class is RowpackWriter:
+                    # Only the table of pages and the page that has the value are read
+                    self.assertEqual(['index:geoid', 'index_pages:geoid'], read_sections)
+
+                self.assertEqual([], rpr.lookup('geoid', u'nothere'))
+                self.assertEqual(4500, len(rpr.lookup('date', d)))
+                self.assertEqual(['date', 'geoid'], sorted(rpr.indexes))
+
+            # Appended rows are added to the index
+            with RowpackWriter('/tmp/foo.rp', 'ab') as rpw:
+                rpw.write_rows([(u'g45000', 45000, d)])
+
+            with RowpackWriter('/tmp/foo.rp', 'r+b') as rpw:
+                rpw.meta['url'] = u'http://example.com'
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertEqual([(u'g45000', 45000, d)], rpr.lookup('geoid', u'g45000'))
+                self.assertEqual([(u'g45000', 45000, d)], rpr.lookup(0, u'g45000'))
+                self.assertEqual(4501, len(rpr.lookup('date', d)))
+
+        # The options of the main command are parsed from the given arguments
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+
+        try:
+            rowpack(['--info', '/tmp/foo.rp'])
+            out = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        self.assertIn('45001', out)
+
+    def test_index_pages(self):
+        import datetime
+        from decimal import Decimal
+        from rowpack import build_index, base
+
+        s = Schema()
+        s.add_column(name='v', datatype='int')
+
+        values = [u'v', u'header'] + list(range(50)) + [2.5, datetime.date(2016, 1, 1),
+                                                         datetime.datetime(2016, 1, 1, 12, 30)]
+
+        page_size = base.INDEX_PAGE_SIZE
+        base.INDEX_PAGE_SIZE = 4
+
+        try:
+            with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+                rpw.write_rows([(v,) for v in values])
+
+            build_index('/tmp/foo.rp', 'v')
+
+            # The appended Decimal is stored as a string, so it is indexed as one
+            with RowpackWriter('/tmp/foo.rp', 'ab', strict=False) as rpw:
+                rpw.write_rows([(Decimal('7.25'),), (u'a',)])
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                for v in values:
+                    self.assertEqual([(v,)], rpr.lookup('v', v), v)
+
+                self.assertEqual([(u'7.25',)], rpr.lookup('v', u'7.25'))
+                self.assertEqual([(u'a',)], rpr.lookup('v', u'a'))
+                self.assertEqual([(2,)], rpr.lookup('v', 2.0))
+
+                for v in (-1, 100, u'', u'zzz', datetime.date(2000, 1, 1), datetime.time(1, 2)):
+                    self.assertEqual([], rpr.lookup('v', v), v)
+
+                self.assertEqual(15, len(rpr.read_section('index:v')))
+                self.assertEqual(57, len(rpr.index('v')))
+        finally:
+            base.INDEX_PAGE_SIZE = page_size
+
+        # NaNs aren't indexed, and don't break the sort of the other values
+        nan = float('nan')
+        values = [float(i) if i % 10 else nan for i in range(100)]
+
+        s = Schema()
+        s.add_column(name='v', datatype='float')
+
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+            rpw.write_rows([(v,) for v in values])
+
+        build_index('/tmp/foo.rp', 'v')
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            self.assertEqual(90, len(rpr.index('v')))
+            self.assertEqual([(1.0,)], rpr.lookup('v', 1.0))
+            self.assertEqual([(99.0,)], rpr.lookup('v', 99.0))
+            self.assertEqual([], rpr.lookup('v', 10.0))
+            self.assertEqual([], rpr.lookup('v', nan))
+
+    def test_mmap(self):
+        import datetime
+
+        N = 25000
+
+        rows = [(i, str(i), datetime.date(2000, 1, 1) + datetime.timedelta(days=i % 365)) for i in range(N)]
+
+        for codec, layout in (('none', 'rows'), ('none', 'columns'), ('gzip', 'rows')):
+            with RowpackWriter('/tmp/foo.rp', 'wb', codec=codec, layout=layout) as rpw:
+                rpw.write_rows(rows)
+
+            with RowpackReader('/tmp/foo.rp', mmap=True) as rpr:
+                self.assertIsNotNone(rpr._mmap)
+                self.assertEqual(rows, list(rpr))
+                self.assertEqual(rows[20000], rpr[20000])
+                self.assertEqual(list(range(N)), list(rpr.column(0)))
+                self.assertEqual(sum(range(N)), sum(r[0] for b in rpr.iter_blocks(parallel=True) for r in b))
+
+            self.assertIsNone(rpr._mmap)
+
+    def test_projection(self):
+        from rowpack import RowpackError
+
+        s = Schema()
+        for name in 'a b c d'.split():
+            s.add_column(name=name, datatype=int)
+
+        N = 25000
+
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+            rpw.write_row(('comment',))
+            for i in range(1, N):
+                rpw.write_row((i, i * 2, i * 3, i * 4))
+
+        with RowpackReader('/tmp/foo.rp', columns=['d', 'b']) as rpr:
+            self.assertEqual(['d', 'b'], rpr.headers)
+
+            rows = list(rpr)
+            self.assertEqual((None, None), rows[0])
+            self.assertEqual((40, 20), rows[10])
+            self.assertEqual((80000, 40000), rpr[20000])
+
+        with RowpackReader('/tmp/foo.rp', columns=[2], workers=2) as rpr:
+            self.assertEqual([(i * 3,) for i in range(1, N)], list(rpr)[1:])
+
+        with self.assertRaises(RowpackError):
+            RowpackReader('/tmp/foo.rp', columns=['x'])
+
+    def test_columnar(self):
+        import datetime
+        from uuid import uuid4
+
+        s = Schema()
+        for name in 'id rand cat uuid float date'.split():
+            s.add_column(name=name)
+
+        N = 25000
+
+        rows = [('title', 'comment')]
+        for i in range(1, N):
+            rows.append((i, (i * 7919) % 1000, 'cat' + str(i % 5), str(uuid4()), float(i) / 3,
+                         datetime.date(2000 + i % 20, 1, 1) if i % 11 else None))
+        rows.append(())
+
+        for workers in (None, 2):
+            with RowpackWriter('/tmp/foo.rp', 'wb', schema=s, layout='columns', workers=workers) as rpw:
+                rpw.write_rows(rows)
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertEqual('columns', rpr.layout)
+                self.assertEqual(rows, [tuple(row) for row in rpr])
+                self.assertEqual(rows[20000], rpr[20000])
+                self.assertEqual(rows[-1], rpr[-1])
+                self.assertEqual([row[3] if len(row) > 3 else None for row in rows], list(rpr.column('uuid')))
+
+            with RowpackReader('/tmp/foo.rp', columns=['date', 'id'], workers=workers) as rpr:
+                self.assertEqual((rows[12][5], rows[12][0]), rpr[12])
+                self.assertEqual((None, 'title'), rpr[0])
+                self.assertEqual([rows[i][5] for i in range(1, 30)], list(rpr.column(5))[1:30])
+
+    def test_zonemaps(self):
+        import datetime
+        from rowpack import RowpackError
+
+        s = Schema()
+        for name in 'year geoid date value'.split():
+            s.add_column(name=name)
+
+        rows = [(2000 + i // 10000, 'g{:06d}'.format(i % 10000), datetime.date(2000 + i // 10000, 1, 1),
+                 i if i % 3 else None)
+                for i in range(100000)]
+
+        for layout in ('rows', 'columns'):
+            with RowpackWriter('/tmp/foo.rp', 'wb', schema=s, layout=layout) as rpw:
+                rpw.write_rows(rows)
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertEqual(10, len(rpr.zonemaps))
+                self.assertEqual((2003, 2003, 0), rpr.zonemaps[3][0])
+                self.assertEqual((datetime.date(2003, 1, 1), datetime.date(2003, 1, 1), 0), rpr.zonemaps[3][2])
+
+                where = [(0, '>=', 2008)]
+                self.assertEqual([8, 9], [n for n in range(10) if rpr.block_may_match(n, where)])
+
+                self.assertEqual([row for row in rows if row[0] == 2004], list(rpr.filter('year', '=', 2004)))
+                self.assertEqual([row for row in rows if row[3] is not None and row[3] < 100],
+                                 list(rpr.filter('value', '<', 100)))
+                self.assertEqual([row for row in rows if row[2] > datetime.date(2008, 6, 1)],
+                                 list(rpr.filter('date', '>', datetime.date(2008, 6, 1))))
+
+            where = [('year', 'in', (2001, 2009)), ('geoid', '<', 'g000010')]
+            with RowpackReader('/tmp/foo.rp', where=where, columns=['value'], workers=2) as rpr:
+                self.assertEqual([(row[3],) for row in rows if row[0] in (2001, 2009) and row[1] < 'g000010'],
+                                 list(rpr))
+
+        with self.assertRaises(RowpackError):
+            RowpackReader('/tmp/foo.rp', where=[('year', '~', 1)])
+
+        # Decimals are stored as strings, so their range is of the strings
+        from decimal import Decimal
+
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s, strict=False) as rpw:
+            rpw.write_rows([(2000, 'g', None, Decimal('9.5')), (2000, 'g', None, Decimal('10.5'))])
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            self.assertEqual((u'10.5', u'9.5', 0), rpr.zonemaps[0][3])
+            self.assertEqual([(2000, u'g', None, u'9.5')], list(rpr.filter('value', '=', '9.5')))
+
+        # NaNs aren't in the range
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+            rpw.write_rows([(2000, 'g', None, float('nan')), (2000, 'g', None, 5.0), (2000, 'g', None, None)])
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            self.assertEqual((5.0, 5.0, 1), rpr.zonemaps[0][3])
+            self.assertEqual([(2000, u'g', None, 5.0)], list(rpr.filter('value', '=', 5.0)))
+
+        # Non-ascii str and unicode values can't be compared, so the range isn't recorded
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+            rpw.write_rows([(2000, u'g\xe9', None, 1), (2000, u'g\xe9'.encode('utf-8'), None, 2)])
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            self.assertEqual((None, None, 0), rpr.zonemaps[0][1])
+            self.assertEqual([1, 2], [row[3] for row in rpr.filter('geoid', '=', u'g\xe9')])
+
+    def test_batches(self):
+
+        N = 25003
+
+        rows = [(i, str(i)) for i in range(N)]
+
+        for layout in ('rows', 'columns'):
+            with RowpackWriter('/tmp/foo.rp', 'wb', layout=layout) as rpw:
+                rpw.write_rows(rows)
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                blocks = list(rpr.iter_blocks())
+                self.assertEqual([10000, 10000, 5003], [len(b) for b in blocks])
+                self.assertEqual(rows, [r for b in blocks for r in b])
+
+                columns = list(rpr.iter_blocks(as_columns=True))
+                self.assertEqual(list(range(N)), [v for c in columns for v in c[0]])
+
+                batches = list(rpr.iter_batches(3000))
+                self.assertEqual([3000] * 8 + [1003], [len(b) for b in batches])
+                self.assertEqual(rows, [r for b in batches for r in b])
+
+                batches = list(rpr.iter_batches(7000, as_columns=True))
+                self.assertEqual([7000, 7000, 7000, 4003], [len(b[0]) for b in batches])
+                self.assertEqual([str(i) for i in range(N)], [v for b in batches for v in b[1]])
+
+                batches = list(rpr.iter_batches(100, where=[(0, '<', 250)]))
+                self.assertEqual([100, 100, 50], [len(b) for b in batches])
+
+    def test_numpy(self):
+        import datetime
+        import numpy as np
+
+        s = Schema()
+        s.add_column(name='id', datatype='int')
+        s.add_column(name='value', datatype='float')
+        s.add_column(name='date', datatype='date')
+        s.add_column(name='name', datatype='text')
+        s.add_column(name='nullable', datatype='int')
+
+        N = 25000
+
+        rows = [(i, i / 2.0, datetime.date(2000, 1, 1) + datetime.timedelta(days=i % 365), u'n' + str(i),
+                 i if i < 20000 else None)
+                for i in range(N)]
+
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+            rpw.write_rows(rows)
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            a = rpr.to_numpy()
+
+            self.assertEqual(N, len(a))
+            self.assertEqual(['id', 'value', 'date', 'name', 'nullable'], list(a.dtype.names))
+            self.assertEqual(np.dtype('int64'), a.dtype['id'])
+            self.assertEqual(np.dtype('float64'), a.dtype['value'])
+            self.assertEqual(np.dtype('datetime64[D]'), a.dtype['date'])
+            self.assertEqual(np.dtype('O'), a.dtype['name'])
+            self.assertEqual(np.dtype('float64'), a.dtype['nullable'])
+
+            self.assertEqual(sum(range(N)), a['id'].sum())
+            self.assertEqual(np.datetime64('2000-01-11'), a['date'][10])
+            self.assertTrue(np.isnan(a['nullable'][-1]))
+
+            batches = list(rpr.iter_numpy(batch_rows=4000, columns=['value', 'id']))
+
+            self.assertEqual([4000] * 6 + [1000], [len(b) for b in batches])
+            self.assertEqual(('value', 'id'), batches[0].dtype.names)
+            self.assertEqual(np.dtype('int64'), batches[0].dtype['id'])
+            self.assertEqual(sum(range(N)), sum(b['id'].sum() for b in batches))
+
+        # Header rows, excluded by the rowspec, don't make the fields objects
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+            rpw.meta['rowspec'] = {'headers': [0], 'start': 1}
+            rpw.write_rows([tuple(s.headers)] + rows)
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            a = rpr.to_numpy()
+            self.assertEqual(N, len(a))
+            self.assertEqual(np.dtype('int64'), a.dtype['id'])
+            self.assertEqual(N, sum(len(b) for b in rpr.iter_numpy(batch_rows=4000)))
+
+            self.assertEqual(N + 1, len(rpr.to_numpy(data_rows=False)))
+            self.assertEqual(np.dtype('O'), rpr.to_numpy(data_rows=False).dtype['id'])
+
+        # Without a schema, the fields are the values of the rows of the first block
+        with RowpackWriter('/tmp/foo.rp', 'wb') as rpw:
+            rpw.write_rows([r[:2] for r in rows])
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            a = rpr.to_numpy()
+            self.assertEqual(('f0', 'f1'), a.dtype.names)
+            self.assertEqual(sum(range(N)), a['f0'].sum())
+            self.assertEqual(N, sum(len(b) for b in rpr.iter_numpy(batch_rows=4000)))
+
+    def test_dataframe(self):
+        import numpy as np
+
+        s = Schema()
+        s.add_column(name='id', datatype='int')
+        s.add_column(name='value', datatype='float')
+        s.add_column(name='name', datatype='text')
+
+        N = 25000
+
+        # Two header rows and a footer row, which are excluded by the rowspec
+        rows = [('id', 'value', 'name'), ('ID', 'Value', 'Name')] + \
+               [(i, i / 2.0, u'n' + str(i)) for i in range(N)] + [('Total', None, None)]
+
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+            rpw.meta['rowspec'] = {'headers': [0, 1], 'start': 2, 'end': N + 1}
+            rpw.write_rows(rows)
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            self.assertEqual((2, N + 2), rpr.data_range())
+
+            df = rpr.to_dataframe()
+
+            self.assertEqual(N, len(df))
+            self.assertEqual(['id', 'value', 'name'], list(df.columns))
+            self.assertEqual(np.dtype('int64'), df['id'].dtype)
+            self.assertEqual(np.dtype('float64'), df['value'].dtype)
+            self.assertEqual(sum(range(N)), df['id'].sum())
+            self.assertEqual(u'n24999', df['name'].iloc[-1])
+
+            df = rpr.to_dataframe(columns=['name'], data_rows=False)
+            self.assertEqual(N + 3, len(df))
+            self.assertEqual('name', df['name'].iloc[0])
+
+            chunks = list(rpr.iter_dataframes(7000, columns=['id', 'value']))
+            self.assertEqual([7000] * 3 + [4000], [len(c) for c in chunks])
+            self.assertEqual(np.dtype('int64'), chunks[-1]['id'].dtype)
+            self.assertEqual(sum(range(N)), sum(c['id'].sum() for c in chunks))
+
+            # Slicing within blocks and skipping blocks
+            self.assertEqual([(10,), (11,), (12,)],
+                             [r for b in rpr.iter_blocks(start=12, stop=15, columns=['id']) for r in b])
+            self.assertEqual(list(range(9998, 10002)),
+                             [r[0] for b in rpr.iter_blocks(start=10000, stop=10004) for r in b])
+            self.assertEqual(list(range(9998, 10002)),
+                             [r[0] for b in rpr.iter_blocks(start=10000, stop=10004, parallel=True) for r in b])
+
+        # Without a schema, the columns are the values of the rows of the first block
+        with RowpackWriter('/tmp/foo.rp', 'wb') as rpw:
+            rpw.write_rows(rows[2:-1])
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            df = rpr.to_dataframe()
+            self.assertEqual(['f0', 'f1', 'f2'], list(df.columns))
+            self.assertEqual(N, len(df))
+            self.assertEqual(sum(range(N)), df['f0'].sum())
+            self.assertEqual([7000] * 3 + [4000], [len(c) for c in rpr.iter_dataframes(7000)])
+
+    def test_head_tail(self):
+        from rowpack.cli import head_tail
+
+        N = 25000
+
+        with RowpackWriter('/tmp/foo.rp', 'wb') as rpw:
+            for i in range(N):
+                rpw.write_row((i, str(i)))
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            rows, headers = head_tail(rpr, head=False)
+
+            self.assertEqual(15, len(rows))
+            self.assertEqual((N - 15, N - 15), rows[0][1:3])
+            self.assertEqual((N - 1, N - 1), rows[-1][1:3])
+
+            rows, headers = head_tail(rpr, head=True)
+
+            self.assertEqual([(i, i) for i in range(15)], [row[1:3] for row in rows])
+
     def test_schema(self):
 
         s = Schema()
@@ -99,7 +1209,7 @@ class TestBasic(unittest.TestCase):
 
         avro_schema, rp_schema = self.schemas();
 
-        rpw = RowpackWriter('/tmp/foo.rp', schema=rp_schema)
+        rpw = RowpackWriter('/tmp/foo.rp', schema=rp_schema, uniques=True)
 
         for row in rows:
             rpw.write_row(row)
@@ -120,6 +1230,310 @@ class TestBasic(unittest.TestCase):
             self.assertEqual('rand', rpr.schema[1].name)
             self.assertEqual(1000, rpr.schema[2].nuniques)
 
+    def test_write_stats(self):
+        from math import isnan, sqrt
+        from rowpack.colstats import ColumnStats
+
+        def mean_std(values):
+            mean = float(sum(values)) / len(values)
+            return mean, sqrt(sum((v - mean) ** 2 for v in values) / len(values))
+
+        s = Schema()
+        s.add_column(name='id', datatype='int')
+        s.add_column(name='value', datatype='float')
+        s.add_column(name='name', datatype='text')
+
+        N = 25001
+
+        rows = [(i, (i % 97) * 1.5 if i % 10 else None, u'n' + str(i % 50)) for i in range(N)]
+
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s, uniques=True) as rpw:
+            rpw.write_rows(rows)
+
+            self.assertEqual(['id', 'value', 'name'], list(rpw.stats().keys()))
+
+        values = [r[1] for r in rows if r[1] is not None]
+        mean, std = mean_std(values)
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            c = rpr.schema[1]
+            self.assertEqual(N, c.count)
+            self.assertEqual(2501, c.nulls)
+            self.assertEqual(0, c.min)
+            self.assertEqual(96 * 1.5, c.max)
+            self.assertAlmostEqual(mean, c.mean)
+            self.assertAlmostEqual(std, c.std)
+            self.assertEqual(sorted(values)[(len(values) - 1) // 2], c.median)
+            self.assertEqual(97, c.nuniques)
+
+            self.assertEqual(12500, rpr.schema[0].median)
+            self.assertEqual(50, rpr.schema[2].nuniques)
+            self.assertTrue(isnan(rpr.schema[2].mean))
+            self.assertEqual(501, rpr.schema[2].uvalues[u'n0'])
+
+        # Merging the stats of parts gives the stats of the whole
+        a, b, whole = ColumnStats('v', float), ColumnStats('v', float), ColumnStats('v', float)
+        a.add_values([r[1] for r in rows[:7]])
+        b.add_values([r[1] for r in rows[7:]])
+        whole.add_values([r[1] for r in rows])
+        a.merge(b)
+
+        self.assertEqual((whole.n, whole.nulls, whole.min, whole.max, whole.median),
+                         (a.n, a.nulls, a.min, a.max, a.median))
+        self.assertAlmostEqual(whole.stddev, a.stddev)
+
+        # Values from CSV sources are strings, which are numeric if they convert with float()
+        strs = ColumnStats('v', int)
+        strs.add_values([u'1', '2', u'3', u'10', u'x', None, u'', u'nan'])
+        self.assertEqual((8, 1, 4), (strs.n, strs.nulls, strs.n_numeric))
+        self.assertEqual((1.0, 10.0, 4.0, 2.0), (strs.min, strs.max, strs.mean, strs.median))
+
+        s2 = Schema()
+        s2.add_column(name='id', datatype='int')
+
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s2, uniques=True) as rpw:
+            rpw.write_rows([(u'id',)] + [(str(i),) for i in range(101)])
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            c = rpr.schema[0]
+            self.assertEqual((102, 101), (c.count, c.numerics))
+            self.assertEqual((0, 100, 50, 50), (c.min, c.max, c.mean, c.median))
+            self.assertAlmostEqual(mean_std(range(101))[1], c.std)
+
+        s = Schema()
+        s.add_column(name='id', datatype='int')
+
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s, stats=False) as rpw:
+            rpw.write_rows(rows)
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            self.assertTrue(isnan(rpr.schema[0].count))
+
+        # By default, only the moments are computed, so the distinct values aren't kept in memory
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s) as rpw:
+            rpw.write_rows(rows)
+
+            self.assertIsNone(rpw.stats()['id'].counts)
+
+        with RowpackReader('/tmp/foo.rp') as rpr:
+            c = rpr.schema[0]
+            self.assertEqual((N, 0, N - 1), (c.count, c.min, c.max))
+            self.assertTrue(isnan(c.nuniques))
+            self.assertTrue(isnan(c.median))
+            self.assertIsNone(c.uvalues)
+
+        # Lists and dicts aren't counted in the uniques
+        s3 = Schema()
+        s3.add_column(name='id', datatype='int')
+        s3.add_column(name='tags', datatype='text')
+
+        for uniques in (False, True):
+            with RowpackWriter('/tmp/foo.rp', 'wb', schema=s3, uniques=uniques) as rpw:
+                rpw.write_rows([(i, [u'a', i]) for i in range(10)] + [(10, {u'a': 1}), (11, u'a')])
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertEqual((1, [u'a', 1]), (rpr[1][0], list(rpr[1][1])))
+                self.assertEqual(12, rpr.schema[1].count)
+
+                if uniques:
+                    self.assertEqual(1, rpr.schema[1].nuniques)
+                    self.assertEqual({u'a': 1}, rpr.schema[1].uvalues)
+
+    def test_old_version_date_stats(self):
+        """Files before version 5 encode dates as dicts, which were unreadable as keys of the uvalues of
+        date columns, after statistics were written"""
+        import datetime
+        from rowpack import run_stats
+
+        class V4Writer(RowpackWriter):
+            VERSION = 4
+
+        s = Schema()
+        s.add_column(name='id', datatype='int')
+        s.add_column(name='date', datatype='date')
+
+        d = datetime.date(2016, 1, 1)
+        rows = [(i, d + datetime.timedelta(days=i % 3)) for i in range(100)]
+
+        for stats in (True, False):
+            with V4Writer('/tmp/foo.rp', 'wb', schema=s, stats=stats, uniques=True) as rpw:
+                rpw.write_rows(rows)
+
+            if not stats:
+                run_stats('/tmp/foo.rp', workers=2)
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertEqual(4, rpr.version)
+                self.assertEqual(rows, list(rpr))
+                self.assertEqual({d: 34, d + datetime.timedelta(days=1): 33, d + datetime.timedelta(days=2): 33},
+                                 rpr.schema[1].uvalues)
+
+    def test_run_stats(self):
+        from rowpack import run_stats
+
+        def schema():
+            s = Schema()
+            s.add_column(name='id', datatype='int')
+            s.add_column(name='value', datatype='float')
+            s.add_column(name='name', datatype='text')
+            return s
+
+        fields = ['count', 'nulls', 'min', 'mean', 'median', 'max', 'std', 'nuniques']
+
+        for N in (25001, 100):
+            rows = [(i, (i % 97) * 1.5 if i % 10 else None, u'n' + str(i % 50)) for i in range(N)]
+
+            with RowpackWriter('/tmp/foo.rp', 'wb', schema=schema()) as rpw:
+                rpw.write_rows(rows)
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                expected = [[getattr(c, f) for f in fields] for c in rpr.schema]
+
+            # Without workers, the blocks are processed in this process
+            for workers in (2, None):
+                with RowpackWriter('/tmp/foo.rp', 'wb', schema=schema(), stats=False) as rpw:
+                    rpw.write_rows(rows)
+
+                stats = run_stats('/tmp/foo.rp', workers=workers)
+
+                self.assertEqual(N, stats['id'].n)
+
+                with RowpackReader('/tmp/foo.rp') as rpr:
+                    for e, c in zip(expected, rpr.schema):
+                        for f, v in zip(fields, e):
+                            if v == v:
+                                self.assertAlmostEqual(v, getattr(c, f))
+
+    def test_sketches(self):
+        import random
+        from collections import Counter
+        from uuid import uuid4
+        from rowpack import run_stats
+        from rowpack.sketch import HyperLogLog, QuantileSketch, MisraGries
+
+        N = 50000
+
+        rnd = random.Random(1)
+
+        ids = [str(uuid4()) for _ in range(N)]
+
+        hll = HyperLogLog()
+        hll.update(ids[:N // 2])
+        hll.merge(HyperLogLog())
+        other = HyperLogLog()
+        other.update(ids[N // 4:])
+        hll.merge(other)
+        self.assertLess(abs(hll.count() - N), N * 0.05)  # About 3 standard errors
+
+        small = HyperLogLog()
+        small.update(ids[:100] * 3)
+        self.assertLess(abs(small.count() - 100), 3)
+
+        nums = [rnd.random() for _ in range(N)]
+        qs = QuantileSketch(k=256, seed=1)
+        for i in range(0, N, 1000):
+            other = QuantileSketch(k=256, seed=i)
+            other.update(nums[i:i + 1000])
+            qs.merge(other)
+
+        self.assertEqual(N, qs.n)
+        self.assertLess(sum(len(l) for l in qs.levels), 256 * len(qs.levels))
+        for q in (0.1, 0.5, 0.9):
+            rank = sorted(nums).index(qs.quantile(q))
+            self.assertLess(abs(rank - q * N), N * 0.05)
+
+        skewed = [int(rnd.paretovariate(1)) for _ in range(N)]
+        mg = MisraGries(20)
+        mg.update(skewed[:N // 2])
+        other = MisraGries(20)
+        other.update(skewed[N // 2:])
+        mg.merge(other)
+
+        exact = Counter(skewed)
+        for v, c in mg.most_common(5):
+            self.assertLessEqual(c, exact[v])
+            self.assertLessEqual(exact[v] - c, N / 21.0)
+        self.assertEqual([v for v, c in exact.most_common(3)], [v for v, c in mg.most_common(3)])
+
+        # Sketched stats in the writer and run_stats
+        s = Schema()
+        s.add_column(name='id', datatype='text')
+        s.add_column(name='value', datatype='float')
+
+        rows = list(zip(ids, nums))
+
+        with RowpackWriter('/tmp/foo.rp', 'wb', schema=s, sketches=True) as rpw:
+            rpw.write_rows(rows)
+
+        for stats in (False, True):
+            if stats:
+                run_stats('/tmp/foo.rp', workers=2, sketches=True)
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                self.assertEqual(N, rpr.schema[0].count)
+                self.assertLess(abs(rpr.schema[0].nuniques - N), N * 0.05)
+                self.assertLess(abs(rpr.schema[1].median - 0.5), 0.05)
+                self.assertAlmostEqual(sum(nums) / N, rpr.schema[1].mean)
+                self.assertLessEqual(len(rpr.schema[0].uvalues), 100)
+
+    def test_ingest_single_pass(self):
+        from decimal import Decimal
+        from rowpack import ingest
+
+        rows = [['Title of the table'], ['id', 'name', 'value']] + \
+               [[i, 'n{}'.format(i), Decimal(i) / 2] for i in range(3000)]
+
+        with stub_rowgenerators(lambda encoding: iter(rows)):
+            path, encoding, warnings = ingest('http://example.com/foo.csv', '/tmp/foo.rp', cache=object(),
+                                              single_pass=True)
+
+        self.assertEqual([], warnings)
+        self.assertEqual('ascii', encoding)
+
+        with RowpackReader('/tmp/foo.rp') as r:
+            self.assertEqual(3002, r.n_rows)
+            self.assertEqual(2, r.meta['rowspec']['start'])
+            self.assertEqual('http://example.com/foo.csv', r.meta['sourcespec']['url'])
+            self.assertEqual(['id', 'name', 'value'], r.schema.headers)
+            self.assertEqual('int', r.schema[0].datatype)
+            self.assertEqual(1499, r.schema[0].median)
+
+            # Values that aren't of the intuited types are stored as strings, as before single pass ingest
+            self.assertEqual('1.5', r[5][2])
+
+    def test_ingest_encodings(self):
+        from rowpack import ingest
+
+        N = 20000
+
+        # The row at which each encoding fails
+        fails_at = {'ascii': 15000, 'utf8': 15110}
+
+        def make_rows(encoding):
+            for i in range(N):
+                if i == fails_at.get(encoding):
+                    raise UnicodeDecodeError(encoding, b'\xe9', 0, 1, 'invalid')
+
+                yield [u'r{}'.format(i), encoding]
+
+        with stub_rowgenerators(make_rows):
+            path, encoding, warnings = ingest('http://example.com/foo.csv', '/tmp/foo.rp', cache=object())
+
+        self.assertEqual('latin1', encoding)
+        self.assertEqual('WARNING: rows were decoded with more than one encoding: ascii from row 0, '
+                         'utf8 from row 15000, latin1 from row 15110', warnings[-1])
+
+        with RowpackReader('/tmp/foo.rp') as r:
+            rows = list(r)
+
+            self.assertEqual(N, len(rows))
+            self.assertEqual([u'r{}'.format(i) for i in range(N)], [row[0] for row in rows])
+
+            # The rows written before an encoding failed are kept, with the encoding they were decoded with
+            self.assertEqual(['ascii'] * 15000 + ['utf8'] * 110 + ['latin1'] * 4890, [row[1] for row in rows])
+            self.assertEqual([[0, 'ascii'], [15000, 'utf8'], [15110, 'latin1']], r.meta['encodings'])
+            self.assertEqual('latin1', r.meta['encoding'])
+
     def test_rowintuit(self):
         from rowpack import intuit_rows
         from rowgenerators import RowGenerator
@@ -189,6 +1603,19 @@ class TestBasic(unittest.TestCase):
         if N == 50000:
             self.assertEquals(1249975000, sum)
 
+        with Timer() as t:
+
+            with RowpackReader('/tmp/foo.rp') as rpr:
+                sum = 0
+                count = 0
+                for rows in rpr.iter_blocks():
+                    sum += reduce(lambda a, row: a + row[0], rows, 0)
+                    count += len(rows)
+
+        print('Read RP blocks         ', float(N) / t.elapsed)
+
+        self.assertEquals(N, count)
+
         with Timer() as t:
 
             with RowpackWriter('/tmp/foo_rows.rp') as rpw: